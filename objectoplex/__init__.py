@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from system import BusinessObject, InvalidObject
+from protocol import Decoder, Encoder, SocketReader
 
 from utils import subscription_object, registration_object, print_readably
-from utils import reply_for_object
+from utils import reply_for_object, wait_readable, connect
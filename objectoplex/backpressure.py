@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Send queues of clients and what they do when a client doesn't keep up.
+
+The queue of a client is over its limit when it holds max_objects objects
+or max_bytes bytes of payload.  Then, depending on the policy:
+
+    block          the put() waits for room, stalling whoever is sending
+    drop-oldest    the oldest queued objects are dropped to make room
+    drop-newest    the new object is dropped
+    disconnect     new objects are dropped and, if the queue stays over the
+                   limit for grace_secs, the client is disconnected
+    spill          objects are written to a temporary file (in
+                   spool_directory) and read back in order as the queue
+                   drains
+
+Every dropped object is counted in 'dropped' and 'dropped_bytes'.
+"""
+import logging
+
+from collections import deque
+from tempfile import TemporaryFile
+from time import time
+
+from gevent.queue import Queue
+from gevent.event import Event
+
+from protocol import Decoder, PartialPayload, default_encoder
+
+logger = logging.getLogger('backpressure')
+
+POLICIES = ('block', 'drop-oldest', 'drop-newest', 'disconnect', 'spill')
+
+_SPILL_READ_BYTES = 65536
+_SPILL_MAX_METADATA_BYTES = 1024 * 1024
+
+
+class SendQueue(Queue):
+    """
+    Queue of objects waiting to be sent to a client; see the module
+    documentation for the policies.  on_slow_consumer is called with no
+    arguments when a client is to be disconnected.
+    """
+    def __init__(self, policy='drop-oldest', max_objects=100, max_bytes=None, grace_secs=10.0,
+                 spool_directory=None, on_slow_consumer=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown backpressure policy %r" % (policy, ))
+
+        Queue.__init__(self)
+        self.policy = policy
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.grace_secs = grace_secs
+        self.spool_directory = spool_directory
+        self.on_slow_consumer = on_slow_consumer
+
+        self.bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.spilled_total = 0
+        self.over_limit_since = None
+        self.slow_consumer = False
+        self.room = Event()
+        self.room.set()
+
+        self.spill_file = None
+        self.spilled = 0
+        self.spill_read_position = 0
+        self.spill_decoder = None
+        self.unspilled = deque()
+
+    def over_limit(self, obj=None):
+        count = len(self.queue) + self.spilled
+        if count == 0:
+            return False
+        if self.max_objects is not None and count >= self.max_objects:
+            return True
+        if self.max_bytes is not None:
+            size = self.bytes
+            if obj is not None:
+                size += obj.size
+            return size > self.max_bytes
+        return False
+
+    def put(self, obj, block=True, timeout=None):
+        if self.spilled > 0:
+            self._spill(obj)
+        elif not self.over_limit(obj):
+            self.over_limit_since = None
+        elif self.policy == 'block':
+            while self.over_limit(obj):
+                self.room.clear()
+                self.room.wait()
+        elif self.policy == 'drop-oldest':
+            while self.over_limit(obj):
+                self._drop(self._get())
+        elif self.policy == 'drop-newest':
+            self._drop(obj)
+            return
+        elif self.policy == 'disconnect':
+            self._drop(obj)
+            now = time()
+            if self.over_limit_since is None:
+                self.over_limit_since = now
+            elif now - self.over_limit_since > self.grace_secs and not self.slow_consumer:
+                self.slow_consumer = True
+                if self.on_slow_consumer is not None:
+                    self.on_slow_consumer()
+            return
+        elif self.policy == 'spill':
+            self._spill(obj)
+
+        if self.spilled > 0:
+            # Wake up a sender waiting for the queue to fill.
+            if self.getters:
+                self._schedule_unlock()
+            return
+
+        Queue.put(self, obj, block, timeout)
+
+    def qsize(self):
+        return len(self.queue) + self.spilled
+
+    def _put(self, obj):
+        self.queue.append(obj)
+        self.bytes += obj.size
+
+    def _get(self):
+        if len(self.queue) > 0:
+            obj = self.queue.popleft()
+            self.bytes -= obj.size
+        else:
+            obj = self._unspill()
+
+        if not self.over_limit():
+            self.room.set()
+        return obj
+
+    def _peek(self):
+        if len(self.queue) > 0:
+            return self.queue[0]
+        obj = self._unspill()
+        self.unspilled.appendleft(obj)
+        self.spilled += 1
+        return obj
+
+    def _drop(self, obj):
+        self.dropped += 1
+        self.dropped_bytes += obj.size
+        logger.debug(u"Send queue over its limit, dropped {0}".format(obj))
+
+    def _spill(self, obj):
+        if isinstance(obj.payload, PartialPayload):
+            # Its payload isn't here yet, so it can't be written out.
+            self._drop(obj)
+            return
+
+        if self.spill_file is None:
+            self.spill_file = TemporaryFile(dir=self.spool_directory)
+            self.spill_decoder = Decoder(max_metadata_bytes=_SPILL_MAX_METADATA_BYTES)
+
+        self.spill_file.seek(0, 2)
+        for buffer in default_encoder.buffers(obj):
+            self.spill_file.write(buffer)
+        self.spilled += 1
+        self.spilled_total += 1
+
+    def _unspill(self):
+        while len(self.unspilled) == 0:
+            self.spill_file.seek(self.spill_read_position)
+            data = self.spill_file.read(_SPILL_READ_BYTES)
+            if len(data) == 0:
+                raise IOError("Spill file of a send queue ended unexpectedly")
+            self.spill_read_position += len(data)
+            self.unspilled.extend(self.spill_decoder.feed(data))
+
+        self.spilled -= 1
+        obj = self.unspilled.popleft()
+        if self.spilled == 0:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_read_position = 0
+        return obj
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
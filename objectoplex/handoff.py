@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Graceful restarts.  The running server starts a successor process that
+inherits its listening sockets; once the successor accepts connections, the
+old server stops accepting, drains the send queues of its clients and exits.
+Connections are accepted by one process or the other all the time, so none
+are refused and clients only need to reconnect.
+
+Clients connected to the old server are not handed over.  Their sockets
+could be (multiprocessing.reduction.send_handle() passes descriptors over a
+Unix domain socket), but their partially received objects, send queues and
+routing state live in the old process and would have to go along with
+them.  They reconnect instead; services back off while doing so.
+
+The successor inherits the listening sockets across fork and exec, with
+FD_CLOEXEC cleared; the descriptor numbers are passed in the environment:
+
+    OBJECTOPLEX_LISTEN_FD   the TCP listening socket
+    OBJECTOPLEX_UNIX_FD     the Unix domain socket, if any
+    OBJECTOPLEX_READY_FD    a pipe the successor writes to once it's serving
+"""
+import errno
+import fcntl
+import logging
+import os
+import socket
+import subprocess
+import sys
+
+from gevent import sleep
+from gevent.select import select
+
+logger = logging.getLogger('handoff')
+
+LISTEN_FD_ENV = 'OBJECTOPLEX_LISTEN_FD'
+UNIX_FD_ENV = 'OBJECTOPLEX_UNIX_FD'
+READY_FD_ENV = 'OBJECTOPLEX_READY_FD'
+
+
+def inherited_listener(variable, family=socket.AF_INET):
+    """
+    Returns the listening socket whose descriptor a predecessor passed in
+    the environment variable, or None.
+    """
+    fd = os.environ.pop(variable, None)
+    if fd is None:
+        return None
+
+    fd = int(fd)
+    sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+    os.close(fd)
+    sock.setblocking(0)
+    return sock
+
+def notify_ready():
+    """
+    Tells the predecessor, if any, that this server accepts connections.
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+
+    fd = int(fd)
+    try:
+        os.write(fd, 'R')
+    except OSError, e:
+        logger.warning(u"Unable to notify the previous server: {0}".format(e))
+    os.close(fd)
+
+def _inheritable(fd):
+    """
+    Clears FD_CLOEXEC of fd and returns its previous descriptor flags.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+    return flags
+
+def _wait_ready(fd, timeout_secs):
+    try:
+        rlist, wlist, xlist = select([fd], [], [], timeout_secs)
+    except IOError, ioe:
+        if ioe.errno != errno.EINTR:
+            raise
+        return False
+    # Nothing but EOF is read if the successor died.
+    return len(rlist) == 1 and os.read(fd, 1) == 'R'
+
+def _terminate(process, timeout_secs):
+    if process.poll() is None:
+        process.terminate()
+    for i in xrange(int(timeout_secs * 10)):
+        if process.poll() is not None:
+            return
+        sleep(0.1)
+    if process.poll() is None:
+        logger.warning(u"New server (pid {0}) didn't terminate, killing it".format(process.pid))
+        process.kill()
+    process.wait()
+
+def restart(server, argv=None, ready_timeout_secs=30.0, drain_timeout_secs=30.0,
+            terminate_timeout_secs=5.0):
+    """
+    Starts a successor of server with argv (by default the command line of
+    this process) and, once it's ready, drains server.  If the successor
+    doesn't get ready in ready_timeout_secs, it's terminated (killed if it
+    hasn't exited in terminate_timeout_secs) and server keeps on serving.
+    Returns True if server was handed off.
+    """
+    if argv is None:
+        argv = [sys.executable] + sys.argv
+
+    env = dict(os.environ)
+    # Descriptor flags of the listening sockets, restored once the
+    # successor has inherited them.
+    listener_flags = {}
+    listener_fd = server.socket.fileno()
+    listener_flags[listener_fd] = _inheritable(listener_fd)
+    env[LISTEN_FD_ENV] = str(listener_fd)
+    if server.unix_server is not None:
+        listener_fd = server.unix_server.socket.fileno()
+        listener_flags[listener_fd] = _inheritable(listener_fd)
+        env[UNIX_FD_ENV] = str(listener_fd)
+    read_fd, write_fd = os.pipe()
+    _inheritable(write_fd)
+    env[READY_FD_ENV] = str(write_fd)
+
+    logger.info(u"Starting a new server: {0}".format(' '.join(argv)))
+    try:
+        process = subprocess.Popen(argv, env=env, close_fds=False)
+    finally:
+        os.close(write_fd)
+        for fd, flags in listener_flags.iteritems():
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+    try:
+        ready = _wait_ready(read_fd, ready_timeout_secs)
+    finally:
+        os.close(read_fd)
+
+    if not ready:
+        logger.error(u"New server (pid {0}) didn't get ready, keeping on serving".format(
+            process.pid))
+        _terminate(process, terminate_timeout_secs)
+        return False
+
+    logger.info(u"New server (pid {0}) is serving, draining this one".format(process.pid))
+    # The Unix domain socket file is the successor's now.
+    server.unlink_unix_socket = False
+    server.drain(drain_timeout_secs)
+    return True
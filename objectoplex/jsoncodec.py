@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and decoding for metadata and JSON payloads.
+
+The fastest of the available implementations (ujson, simplejson, the
+standard library json) is picked when this module is imported; set
+OBJECTOPLEX_JSON to the name of one to use it instead.  All of them
+produce UTF-8 without escaping non-ASCII characters and raise ValueError
+for invalid input, which includes NaN, Infinity and numbers too large for
+a float (1e400): those couldn't be encoded again.  Integers of any size
+are encoded and decoded.
+
+    dumps(obj, indent=None) returns unicode
+    dumpb(obj) returns UTF-8 encoded str (bytes)
+    loads(data) accepts unicode or UTF-8 encoded bytes (str or bytearray)
+"""
+import json
+import logging
+import re
+
+from os import environ as env
+
+logger = logging.getLogger('jsoncodec')
+
+# Looks for a number with an exponent, the only kind ujson decodes to
+# infinity.  Strings like ": 5e3" match as well and are decoded slowly.
+_EXPONENT = re.compile(r'(?:^|[:,\[])\s*-?[0-9.]+[eE]')
+_INFINITY = float('inf')
+
+
+def _finite_float(literal):
+    ret = float(literal)
+    if ret in (_INFINITY, -_INFINITY):
+        raise ValueError(u"Number out of range: {0}".format(literal))
+    return ret
+
+def _reject_constant(name):
+    raise ValueError(u"Not a JSON number: {0}".format(name))
+
+
+class JsonCodec(object):
+    """
+    The standard library json module.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self.json = json
+        self.decoder = json.JSONDecoder(parse_float=_finite_float,
+                                        parse_constant=_reject_constant)
+
+    def dumps(self, obj, indent=None):
+        ret = self.json.dumps(obj, ensure_ascii=False, indent=indent, allow_nan=False)
+        if isinstance(ret, str):
+            return ret.decode('utf-8')
+        return ret
+
+    def dumpb(self, obj):
+        ret = self.json.dumps(obj, ensure_ascii=False, allow_nan=False)
+        if isinstance(ret, unicode):
+            return ret.encode('utf-8')
+        return ret
+
+    def loads(self, data):
+        if not isinstance(data, unicode):
+            data = data.decode('utf-8')
+        return self.decoder.decode(data)
+
+
+class SimplejsonCodec(JsonCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.json = simplejson
+        self.decoder = simplejson.JSONDecoder(parse_float=_finite_float,
+                                              parse_constant=_reject_constant)
+
+    def loads(self, data):
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        return self.decoder.decode(data)
+
+
+class UjsonCodec(JsonCodec):
+    """
+    ujson, which decodes numbers like 1e400 to infinity.  Input with such
+    numbers is left to the standard library, which rejects them, as are
+    integers wider than 64 bits, which ujson can't handle at all.
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        JsonCodec.__init__(self)
+        self.ujson = ujson
+
+    def dumps(self, obj, indent=None):
+        if indent is not None:
+            return JsonCodec.dumps(self, obj, indent)
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj):
+        try:
+            return self.ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        except OverflowError, oe:
+            return JsonCodec.dumpb(self, obj)
+
+    def loads(self, data):
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        if _EXPONENT.search(data) is not None:
+            return JsonCodec.loads(self, data)
+        try:
+            return self.ujson.loads(data)
+        except ValueError, ve:
+            # Invalid input is rejected again.
+            return JsonCodec.loads(self, data)
+
+
+def available_codecs():
+    """
+    Returns instances of the available codecs, fastest first.
+    """
+    ret = []
+    for cls in [UjsonCodec, SimplejsonCodec]:
+        try:
+            ret.append(cls())
+        except ImportError, ie:
+            pass
+    ret.append(JsonCodec())
+    return ret
+
+def _choose_codec():
+    codecs = available_codecs()
+    wanted = env.get('OBJECTOPLEX_JSON', None)
+    for codec in codecs:
+        if codec.name == wanted:
+            return codec
+    if wanted is not None:
+        logger.warning(u"JSON codec {0} is not available, using {1}".format(wanted, codecs[0].name))
+    return codecs[0]
+
+codec = _choose_codec()
+
+dumps = codec.dumps
+dumpb = codec.dumpb
+loads = codec.loads
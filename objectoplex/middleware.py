@@ -3,22 +3,35 @@ from __future__ import print_function
 
 import hashlib
 import logging
-import json
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from collections import defaultdict
+from time import time
 from uuid import uuid4
 from os import environ as env
 from random import choice
 
+import jsoncodec
+
 from system import BusinessObject
+from protocol import default_encoder, encoders, negotiate_encoder, PartialPayload
+from backpressure import POLICIES
+from workers import merge_statistics
 from server import SystemClient
-from rule_engine import routing_decision
+from rule_engine import compile_rules, SubscriptionIndex
 
 logger = logging.getLogger('middleware')
 
+# Neighbor announcements refresh learned routes every five minutes.
+_ROUTE_TTL_SECS = 15 * 60.0
+
 
 class Middleware(object):
+    # Seconds between calls of periodical(), or None for no calls.
+    periodical_interval = 1.0
+    # Events of the objects handle() is called for, or None for all objects.
+    events = None
+
     def handle(self, message, client, clients):
         """
         Return None to signify that this message is handled and doesn't need
@@ -34,16 +47,60 @@ class Middleware(object):
         """
         pass
 
+    def schedule(self, server):
+        """
+        Called once by the server to register the timers of the middleware
+        with server.scheduler (see scheduler.Scheduler).  By default
+        periodical() is called every periodical_interval seconds if the
+        middleware implements it.
+        """
+        if self.periodical_interval is None or not overrides(self, 'periodical'):
+            return
+        server.scheduler.call_every(self.periodical_interval,
+                                    lambda: self.periodical(server.snapshot))
+
     def connect(self, client, clients):
         pass
 
     def disconnect(self, client, clients):
         pass
 
+def overrides(middleware, hook):
+    """
+    Tells whether middleware implements hook rather than inheriting the
+    no-op of Middleware.
+    """
+    return getattr(type(middleware), hook).im_func is not getattr(Middleware, hook).im_func
+
+
+class Pipeline(object):
+    """
+    The middlewares of a server compiled for dispatch.  Hooks a middleware
+    doesn't implement are skipped, and handle() is only called for objects
+    with one of the events of the middleware.  The middlewares for an
+    object are picked by its event when it enters the pipeline.
+    """
+    def __init__(self, middlewares):
+        handlers = [m for m in middlewares if overrides(m, 'handle')]
+        self.default = tuple(m for m in handlers if getattr(m, 'events', None) is None)
+        self.by_event = {}
+        for middleware in handlers:
+            for event in getattr(middleware, 'events', None) or ():
+                self.by_event[event] = tuple(
+                    m for m in handlers
+                    if getattr(m, 'events', None) is None or event in m.events)
+
+        self.connect = tuple(m for m in middlewares if overrides(m, 'connect'))
+        self.disconnect = tuple(m for m in middlewares if overrides(m, 'disconnect'))
+
+    def handlers(self, obj):
+        return self.by_event.get(obj.event, self.default)
+
 
 class ChecksumMiddleware(Middleware):
     def handle(self, obj, *args):
-        if 'sha1' not in obj.metadata and obj.size > 0:
+        if 'sha1' not in obj.metadata and obj.size > 0 and \
+           not isinstance(obj.payload, PartialPayload):
             obj.metadata['sha1'] = hashlib.sha1(obj.payload).hexdigest()
         return obj
 
@@ -56,7 +113,17 @@ class MultiplexingMiddleware(Middleware):
 
 
 class StatisticsMiddleware(Middleware):
-    def __init__(self):
+    """
+    Keeps statistics and answers server/statistics.  When running as one of
+    several workers, shared is a workers.SharedStatistics where the
+    statistics of this worker (index worker) are published every second and
+    from where those of the other workers are merged into replies.
+    """
+    def __init__(self, shared=None, worker=0):
+        self.shared = shared
+        self.worker = worker
+        if shared is None:
+            self.periodical_interval = None
         self.received_objects = 0
         self.client_count = 0
         self.bytes_in = 0
@@ -66,6 +133,10 @@ class StatisticsMiddleware(Middleware):
         self.events_by_type = defaultdict(int)
         self.started = datetime.now()
         self.average_send_queue_length = 0
+        self.dropped_objects = 0
+        self.dropped_bytes = 0
+        self.spilled_objects = 0
+        self.slow_consumers_disconnected = 0
 
     def handle(self, obj, sender, clients):
         self.received_objects += 1
@@ -79,26 +150,47 @@ class StatisticsMiddleware(Middleware):
             self.events_by_type[str(obj.event)] += 1
 
         if obj.event == 'server/statistics':
-            self.send_statistics(sender, obj.id)
+            self.send_statistics(sender, obj.id, clients)
             return None
 
+        # Links to the other workers of this server aren't clients.
+        clients = [client for client in clients if not client.worker_link]
         self.client_count = len(clients)
-        self.bytes_in += len(obj.serialize())
+        self.bytes_in += len(default_encoder.encode_metadata(obj)) + obj.size
 
         queue_length_sum = 0
         for client in clients:
             queue_length_sum += client.queue.qsize()
-        self.average_send_queue_length = float(queue_length_sum) / float(len(clients))
+        if len(clients) > 0:
+            self.average_send_queue_length = float(queue_length_sum) / float(len(clients))
+        else:
+            self.average_send_queue_length = 0
 
         return obj
 
+    def periodical(self, clients):
+        if self.shared is not None:
+            server = None
+            for client in clients:
+                server = client.gateway
+                break
+            self.shared.publish(self.worker, self.statistics(clients, server))
+
     def connect(self, client, clients):
-        self.clients_connected_total += 1
+        if not client.worker_link:
+            self.clients_connected_total += 1
 
     def disconnect(self, client, clients):
-        self.clients_disconnected_total += 1
-
-    def send_statistics(self, client, original_id):
+        if not client.worker_link:
+            self.clients_disconnected_total += 1
+        self.dropped_objects += client.queue.dropped
+        self.dropped_bytes += client.queue.dropped_bytes
+        self.spilled_objects += client.queue.spilled_total
+        if client.queue.slow_consumer:
+            self.slow_consumers_disconnected += 1
+
+    def statistics(self, clients, server=None):
+        queues = [c.queue for c in clients]
         statistics = {
             'received objects': self.received_objects,
             'clients connected total': self.clients_connected_total,
@@ -108,8 +200,24 @@ class StatisticsMiddleware(Middleware):
             'client count': self.client_count,
             'bytes in': self.bytes_in,
             'average send queue length': self.average_send_queue_length,
+            'dropped objects': self.dropped_objects + sum(q.dropped for q in queues),
+            'dropped bytes': self.dropped_bytes + sum(q.dropped_bytes for q in queues),
+            'spilled objects': self.spilled_objects + sum(q.spilled_total for q in queues),
+            'slow consumers disconnected': self.slow_consumers_disconnected,
             }
-        payload = bytearray(json.dumps(statistics, ensure_ascii=False), encoding='utf-8')
+        if server is not None and server.seen is not None:
+            statistics['duplicates dropped'] = server.duplicates_dropped
+            statistics['seen id hits'] = server.seen.hits
+            statistics['seen id misses'] = server.seen.misses
+        return statistics
+
+    def send_statistics(self, client, original_id, clients):
+        statistics = self.statistics(clients, client.gateway)
+        if self.shared is not None:
+            statistics = merge_statistics([statistics] + self.shared.collect(exclude=self.worker),
+                                          averaged=['average send queue length'])
+            statistics['workers'] = self.shared.workers
+        payload = bytearray(jsoncodec.dumpb(statistics))
 
         metadata = {
             'event': 'server/statistics/reply',
@@ -135,7 +243,159 @@ class StdErrMiddleware(Middleware):
         return obj
 
 
+class RoutingDirectory(object):
+    """
+    The clients by their routing ids, extra routing ids included.
+    """
+    def __init__(self):
+        self.clients = {}
+        self.routing_ids = {}
+
+    def update(self, client):
+        self.remove(client)
+
+        routing_ids = set(routing_id for routing_id in
+                          [client.routing_id] + list(client.extra_routing_ids)
+                          if isinstance(routing_id, basestring))
+        for routing_id in routing_ids:
+            self.clients.setdefault(routing_id, set()).add(client)
+        self.routing_ids[client] = routing_ids
+
+    def remove(self, client):
+        for routing_id in self.routing_ids.pop(client, ()):
+            clients = self.clients[routing_id]
+            clients.discard(client)
+            if len(clients) == 0:
+                del self.clients[routing_id]
+
+    def lookup(self, routing_id_or_list):
+        """
+        Returns the clients having any of the routing ids, and a list of the
+        routing ids that weren't found.
+        """
+        if isinstance(routing_id_or_list, basestring):
+            routing_id_or_list = [routing_id_or_list]
+
+        found = set()
+        missing = []
+        for routing_id in routing_id_or_list:
+            clients = self.clients.get(routing_id) if isinstance(routing_id, basestring) else None
+            if clients is None:
+                missing.append(routing_id)
+            else:
+                found.update(clients)
+        return found, missing
+
+
+class RoutingTable(object):
+    """
+    Which linked server leads to a routing id, learned from the objects
+    arriving from linked servers: the origin and the last hop of their
+    route, the subscribed client of subscription notifications and the node
+    and neighbors of neighbor announcements.  The distance is the number of
+    hops in the route; a fresh entry is replaced only by a shorter path or
+    by news from its own link, so that meshed servers don't learn a longer
+    path (or each other) as the way to a routing id just because a copy
+    came in late.  Entries expire after ttl_secs unless learned again.
+    """
+    def __init__(self, ttl_secs=_ROUTE_TTL_SECS):
+        self.ttl_secs = ttl_secs
+        # Routing id -> (routing id of the linked server, distance, time learned).
+        self.next_hops = {}
+
+    def learn(self, obj, link):
+        route = obj.metadata.get('route', [])
+        if not isinstance(route, list):
+            return
+        distance = len(route)
+        learned = []
+        if len(route) > 0:
+            learned.append((route[0], distance))
+            learned.append((route[-1], 1))
+        if obj.event == 'routing/subscribe/notification':
+            learned.append((obj.metadata.get('routing-id'), distance + 1))
+        elif obj.event == 'routing/announcement/neighbors':
+            learned.append((obj.metadata.get('node'), distance))
+            learned.extend((neighbor.get('routing-id'), distance + 1)
+                           for neighbor in obj.metadata.get('neighbors', [])
+                           if isinstance(neighbor, dict))
+
+        now = time()
+        for routing_id, distance in learned:
+            if isinstance(routing_id, basestring):
+                self._update(routing_id, link, distance, now)
+
+        if obj.event == 'routing/disconnect':
+            self.forget(obj.metadata.get('routing-id'))
+
+    def _update(self, routing_id, link, distance, now):
+        entry = self.next_hops.get(routing_id, None)
+        if entry is not None:
+            next_hop, known_distance, learned = entry
+            if next_hop != link and distance >= known_distance and \
+               now - learned <= self.ttl_secs:
+                return
+        self.next_hops[routing_id] = (link, distance, now)
+
+    def forget(self, routing_id):
+        if isinstance(routing_id, basestring):
+            self.next_hops.pop(routing_id, None)
+
+    def forget_link(self, link):
+        for routing_id, (next_hop, distance, learned) in self.next_hops.items():
+            if next_hop == link:
+                del self.next_hops[routing_id]
+
+    def next_hop(self, routing_id):
+        if not isinstance(routing_id, basestring):
+            return None
+        next_hop, distance, learned = self.next_hops.get(routing_id, (None, None, None))
+        if next_hop is None or time() - learned > self.ttl_secs:
+            return None
+        return next_hop
+
+    def prune(self):
+        expired = time() - self.ttl_secs
+        for routing_id, (next_hop, distance, learned) in self.next_hops.items():
+            if learned < expired:
+                del self.next_hops[routing_id]
+
+
 class RoutedSystemClient(SystemClient):
+    def _get_routing_id(self):
+        return self._routing_id
+
+    def _set_routing_id(self, routing_id):
+        self._routing_id = routing_id
+        if self.directory is not None:
+            self.directory.update(self)
+
+    def _get_extra_routing_ids(self):
+        return self._extra_routing_ids
+
+    def _set_extra_routing_ids(self, extra_routing_ids):
+        self._extra_routing_ids = extra_routing_ids
+        if self.directory is not None:
+            self.directory.update(self)
+
+    # Assigning (not modifying) these updates the directory of
+    # RoutingMiddleware.
+    routing_id = property(_get_routing_id, _set_routing_id)
+    extra_routing_ids = property(_get_extra_routing_ids, _set_extra_routing_ids)
+
+    def _get_subscriptions(self):
+        return self._subscriptions
+
+    def _set_subscriptions(self, subscriptions):
+        self._subscriptions = subscriptions
+        self.rules = compile_rules(subscriptions)
+        if self.subscription_index is not None:
+            self.subscription_index.update(self, self.rules)
+
+    # Assigning subscriptions compiles them into rules and updates the
+    # index of RoutingMiddleware.
+    subscriptions = property(_get_subscriptions, _set_subscriptions)
+
     def has_routing_id(self, routing_id_or_list):
         if isinstance(routing_id_or_list, basestring):
             return self._check_routing_id(routing_id_or_list)
@@ -152,34 +412,33 @@ class RoutedSystemClient(SystemClient):
             return True
         return False
 
-    def send(self, message, sender):
-        if self.queue.full():
-            self.queue.get()
-            logger.warning(u"{0} send queue is full, dropped oldest item!".format(self))
-
-        super(RoutedSystemClient, self).send(message, sender)
-
     @classmethod
     def promote(cls, instance, obj=None):
         if instance.__class__ == cls:
             return
 
         instance.__class__ = cls
+        instance.directory = None
         instance.routing_id = make_routing_id(registration_object=obj)
         instance.extra_routing_ids = []
         instance.echo = False
+        instance.subscription_index = None
         instance.subscriptions = []
         instance.subscribed = False
         instance.subscribed_to = False
 
-def make_server_subscription(routing_id):
+def make_server_subscription(routing_id, compression=False):
     metadata = {'event': 'routing/subscribe',
                 'role': 'server',
                 'routing-id': routing_id,
                 'subscriptions': ['*'],
                 'name': 'Objectoplex',
-                'user': env.get('USER', 'unknown-user')
+                'user': env.get('USER', 'unknown-user'),
+                # Preferred first; the peer answers with the one it chose.
+                'metadata-encoding': sorted(encoders, reverse=True)
                 }
+    if compression:
+        metadata['payload-compression'] = ['deflate']
     return BusinessObject(metadata, None)
 
 def make_routing_id(registration_object=None):
@@ -193,12 +452,36 @@ def make_routing_id(registration_object=None):
 
 
 class RoutingMiddleware(Middleware):
-    def __init__(self):
+    """
+    Objects with a 'to' field are sent only toward the linked servers that
+    lead to the addressed routing ids according to a RoutingTable, and to
+    every linked server if some of the ids are unknown.
+
+    A linked server may be connected through several connections (see
+    ObjectoPlex link_connections); each object is sent over one of them.
+    Objects of less than bulk_link_bytes go over the oldest connection and
+    larger ones over the others, chosen by the original sender, so big
+    payloads don't hold up small objects.  Objects of one size class from
+    one sender stay in order.
+    """
+    # Neighbor announcements are sent every five minutes.
+    periodical_interval = 5 * 60.0
+
+    def __init__(self, bulk_link_bytes=64 * 1024):
         self.routing_id = make_routing_id() # routing id of the server
-        self.last_announcement = datetime.now()
+        self.bulk_link_bytes = bulk_link_bytes
+        # Routing id of a linked server -> its connections, oldest first.
+        self.links = {}
+        self.index = SubscriptionIndex()
+        self.directory = RoutingDirectory()
+        self.table = RoutingTable()
 
     def connect(self, client, clients):
         RoutedSystemClient.promote(client, None)
+        client.subscription_index = self.index
+        self.index.update(client, client.rules)
+        client.directory = self.directory
+        self.directory.update(client)
 
         if client.server:
             self.subscribe_to_server(client)
@@ -214,6 +497,20 @@ class RoutingMiddleware(Middleware):
         else:
             logger.info(u"Client {0} disconnected!".format(client))
 
+        client.subscription_index = None
+        self.index.remove(client)
+        client.directory = None
+        self.directory.remove(client)
+
+        links = self.links.get(client.routing_id, [])
+        if client in links:
+            links.remove(client)
+            if len(links) > 0:
+                # The server is still connected through its other links.
+                return
+            del self.links[client.routing_id]
+            self.table.forget_link(client.routing_id)
+
         if client.subscribed:
             self.route(BusinessObject({ 'event': 'routing/disconnect',
                                         'routing-id': client.routing_id }, None), None, clients)
@@ -229,10 +526,8 @@ class RoutingMiddleware(Middleware):
             return self.route(obj, sender, clients)
 
     def periodical(self, clients):
-        now = datetime.now()
-        if now > self.last_announcement + timedelta(minutes=5):
-            self.last_announcement = now
-            self.route(self.neighbor_announcement(clients), None, clients)
+        self.table.prune()
+        self.route(self.neighbor_announcement(clients), None, clients)
 
     def neighbor_announcement(self, clients):
         logger.debug("Sending neighbor announcement")
@@ -247,8 +542,11 @@ class RoutingMiddleware(Middleware):
     def subscribe_to_server(self, client):
         if client.subscribed_to:
             return
-        subscription = make_server_subscription(self.routing_id)
+        subscription = make_server_subscription(
+            self.routing_id, compression=client.gateway.compression_threshold is not None)
         client.send(subscription, None)
+        if 'payload-compression' in subscription.metadata:
+            client.accept_compression()
         client.subscriptions = ['*']
         client.echo = False
         client.subscribed_to = True
@@ -261,13 +559,19 @@ class RoutingMiddleware(Middleware):
         client.echo = False
         client.server = True
         client.subscribed = True
+        client.encoder = RoutingMiddleware.client_encoder(obj, client)
+        links = self.links.setdefault(client.routing_id, [])
+        if client not in links:
+            links.append(client)
 
         self.subscribe_to_server(client)
 
-        client.send(BusinessObject({ 'event': 'routing/subscribe/reply',
-                                     'routing-id': client.routing_id,
-                                     'in-reply-to': obj.id,
-                                     'role': 'server' }, None), None)
+        reply = { 'event': 'routing/subscribe/reply',
+                  'routing-id': client.routing_id,
+                  'in-reply-to': obj.id,
+                  'role': 'server' }
+        reply.update(client.encoder.options())
+        client.send(BusinessObject(reply, None), None)
 
         notification = BusinessObject({ 'event': 'routing/subscribe/notification',
                                         'routing-id': client.routing_id,
@@ -286,13 +590,21 @@ class RoutingMiddleware(Middleware):
         client.echo = False
         client.server = False
         client.subscribed = True
+        client.encoder = RoutingMiddleware.client_encoder(obj, client)
+        # A client may not make the server wait for it.
+        backpressure = obj.metadata.get('backpressure', None)
+        if backpressure in POLICIES and backpressure != 'block':
+            client.queue.policy = backpressure
 
         notification = BusinessObject({ 'event': 'routing/subscribe/notification',
                                         'routing-id': client.routing_id }, None)
         # Send a registration reply
-        client.send(BusinessObject({ 'event': 'routing/subscribe/reply',
-                                     'routing-id': client.routing_id,
-                                     'in-reply-to': obj.id }, None), None)
+        reply = { 'event': 'routing/subscribe/reply',
+                  'routing-id': client.routing_id,
+                  'in-reply-to': obj.id,
+                  'backpressure': client.queue.policy }
+        reply.update(client.encoder.options())
+        client.send(BusinessObject(reply, None), None)
 
         for c in clients:
             if c != client:
@@ -301,6 +613,16 @@ class RoutingMiddleware(Middleware):
         self.route(self.neighbor_announcement(clients), None, clients)
         logger.info(u"Client {0} subscribed!".format(client))
 
+    @classmethod
+    def client_encoder(cls, obj, client):
+        encoder = negotiate_encoder(obj.metadata.get('metadata-encoding'),
+                                    obj.metadata.get('payload-compression'),
+                                    client.gateway.compression_threshold,
+                                    client.gateway.compression_types)
+        if 'payload-compression' in encoder.options():
+            client.accept_compression()
+        return encoder
+
     @classmethod
     def is_server(cls, obj):
         if 'role' in obj.metadata and obj.metadata['role'] == 'server':
@@ -327,29 +649,89 @@ class RoutingMiddleware(Middleware):
             logger.warning("Dropped {0}, {1} not subscribed!".format(obj, sender))
             return
 
-        if 'route' in obj.metadata:
-            route = obj.metadata['route']
-        else:
-            route = []
-            obj.metadata['route'] = route
+        route = obj.metadata.get('route', [])
 
         if self.routing_id in route:
             return False
 
-        if len(route) == 0 and sender is not None:
-            route.append(sender.routing_id)
-        route.append(self.routing_id)
+        if sender is not None and sender.server and sender.routing_id in self.links:
+            self.table.learn(obj, sender.routing_id)
 
-        for recipient in clients:
-            # print('---')
-            # print(obj.metadata)
-            # print(self.should_route_to(obj, sender, recipient), recipient, recipient.routing_id)
-            # print('---')
+        # A new list is assigned (rather than appended to) so that the
+        # encoded metadata cached in the object gets invalidated.
+        if len(route) == 0 and sender is not None:
+            route = [sender.routing_id]
+        obj.metadata['route'] = route + [self.routing_id]
 
-            if self.should_route_to(obj, sender, recipient)[0]:
+        # Only the linked servers and the clients the object is addressed
+        # to or whose subscriptions pass it are looked at, not every client.
+        next_hops = None
+        if 'to' in obj.metadata:
+            recipients, missing = self.directory.lookup(obj.metadata['to'])
+            for recipient in recipients:
+                if recipient.server:
+                    # Reached over its links below.
+                    missing.append(recipient.routing_id)
+                elif recipient in clients and self.should_route_to(obj, sender, recipient)[0]:
+                    recipient.send(obj, sender)
+            if len(missing) == 0:
+                return
+            next_hops = self.next_hops(missing)
+            if next_hops is not None and any(hop in route for hop in next_hops):
+                # The route tables of the servers disagree; flooding still
+                # reaches the destination where going back wouldn't.
+                next_hops = None
+        else:
+            for recipient in self.index.recipients(obj):
+                if recipient.server or recipient not in clients:
+                    continue
+                if self.may_route_to(obj, sender, recipient)[0] is not False:
+                    recipient.send(obj, sender)
+
+        for routing_id, links in self.links.items():
+            if next_hops is not None and routing_id not in next_hops:
+                continue
+            recipient = self.link_for(obj, links)
+            if recipient in clients and self.should_route_to(obj, sender, recipient)[0]:
                 recipient.send(obj, sender)
 
+    def next_hops(self, routing_ids):
+        """
+        Returns the routing ids of the linked servers leading to routing_ids,
+        or None if some of them are unknown.
+        """
+        next_hops = set()
+        for routing_id in routing_ids:
+            if not isinstance(routing_id, basestring):
+                return None
+            if routing_id in self.links:
+                next_hops.add(routing_id)
+                continue
+            next_hop = self.table.next_hop(routing_id)
+            if next_hop is None or next_hop not in self.links:
+                return None
+            next_hops.add(next_hop)
+        return next_hops
+
+    def link_for(self, obj, links):
+        if len(links) == 1 or obj.size < self.bulk_link_bytes:
+            return links[0]
+        sender = obj.metadata['route'][0]
+        return links[1 + hash(sender) % (len(links) - 1)]
+
     def should_route_to(self, obj, sender, recipient):
+        decision, reason = self.may_route_to(obj, sender, recipient)
+        if decision is not None:
+            return decision, reason
+
+        decision = recipient.rules.passes(obj)
+        return decision, "decision made by compiled subscription rules"
+
+    def may_route_to(self, obj, sender, recipient):
+        """
+        Like should_route_to() but returns None as the decision when it is
+        up to the subscriptions of recipient.
+        """
         if not recipient.subscribed:
             return False, 'recipient not yet subscribed'
 
@@ -377,8 +759,7 @@ class RoutingMiddleware(Middleware):
         if sender is recipient and recipient.echo is True:
             return False, "echo false"
 
-        decision = routing_decision(obj, recipient.subscriptions)
-        return decision, "decision made by rule_engine.routing_decision"
+        return None, "up to subscriptions"
 
 
 class MOTDMiddleware(Middleware):
@@ -393,6 +774,8 @@ class MOTDMiddleware(Middleware):
 
 
 class LegacySubscriptionMiddleware(Middleware):
+    events = ('routing/subscribe', 'clients/register')
+
     def handle(self, obj, sender, clients):
         if obj.event == 'routing/subscribe' and \
            ('receive-mode' in obj.metadata or 'receive_mode' in obj.metadata):
@@ -414,8 +797,7 @@ class LegacySubscriptionMiddleware(Middleware):
             if isinstance(routing_ids, basestring):
                 logger.error(u"Got {0} as routing-ids from {1}".format(routing_ids, client))
             else:
-                for routing_id in routing_ids:
-                    client.extra_routing_ids.append(routing_id)
+                client.extra_routing_ids = client.extra_routing_ids + list(routing_ids)
 
         client.receive_mode = obj.metadata.get('receive', 'all')
         client.types = obj.metadata.get('subscriptions', 'all')
@@ -453,8 +835,7 @@ class LegacySubscriptionMiddleware(Middleware):
             if isinstance(routing_ids, basestring):
                 logger.error(u"Got {0} as routing-ids from {1}".format(routing_ids, client))
             else:
-                for routing_id in routing_ids:
-                    client.extra_routing_ids.append(routing_id)
+                client.extra_routing_ids = client.extra_routing_ids + list(routing_ids)
 
         # receive-mode handling
         receive_mode = obj.metadata.get('receive-mode', obj.metadata.get('receive_mode', 'none'))
@@ -491,6 +872,8 @@ class LegacySubscriptionMiddleware(Middleware):
 
 
 class PingPongMiddleware(Middleware):
+    events = ('ping', )
+
     def handle(self, obj, sender, *args, **kwargs):
         if obj.event == 'ping' and isinstance(sender, RoutedSystemClient) and \
            sender.subscribed:
@@ -0,0 +1,730 @@
+# -*- coding: utf-8 -*-
+"""
+The object system wire format without any I/O: every object is its metadata
+as a JSON object terminated by a NUL byte, followed by 'size' bytes of
+payload.
+
+Decoder is fed whatever bytes happen to arrive and returns the objects they
+complete, Encoder turns objects back into bytes.  SocketReader drives a
+Decoder from a blocking (or gevent) socket.
+
+Metadata may also be MessagePack (if the msgpack module is available),
+framed as a marker byte and the length of the packed metadata instead of
+NUL-terminated; peers ask for it with 'metadata-encoding' in their
+routing/subscribe object.
+
+Payloads larger than a configurable threshold are spooled to a memory map
+of an anonymous temporary file instead of the heap.  With cut-through
+enabled, objects with large payloads are returned as soon as their metadata
+has been decoded, with a PartialPayload that fills up as bytes arrive.
+
+Payloads can be deflated per link ('payload-compression' in the subscribe
+object); the frame then says so in its metadata.  Inflated payloads are
+limited in size, and a Decoder may refuse compressed payloads altogether.
+"""
+import mmap
+import struct
+import zlib
+
+from collections import deque
+from tempfile import TemporaryFile
+from time import time
+from weakref import WeakKeyDictionary, proxy
+
+try:
+    import msgpack
+except ImportError, e:
+    msgpack = None
+
+import jsoncodec
+
+from system import BusinessObject, InvalidObject, InvalidMetadata
+
+_MAX_METADATA_BYTES = 2048
+_BINARY_MARKER = 0x01
+_BINARY_MARKER_BYTE = chr(_BINARY_MARKER)
+_BINARY_LENGTH = struct.Struct('>I')
+_BINARY_HEADER_BYTES = 1 + _BINARY_LENGTH.size
+_COMPRESSION = 'deflate'
+_COMPRESSION_THRESHOLD = 1024
+_MAX_INFLATED_BYTES = 64 * 1024 * 1024
+_COMPRESSIBLE_TYPES = ('text/*', 'application/json', 'application/javascript',
+                       'application/xml')
+_CHUNK_SIZE = 65536
+_COALESCE_BYTES = 16384
+
+
+def spool(size, directory=None):
+    """
+    Returns a writable memory map of size bytes backed by an anonymous
+    temporary file, so that the pages can be written back to disk instead
+    of growing the heap.
+    """
+    with TemporaryFile(dir=directory) as f:
+        f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+
+def payload_slice(payload, start, end):
+    """
+    Returns bytes start:end of a payload without copying them.  Memory maps
+    only have the old buffer interface on Python 2, so they are sliced with
+    buffer() there.
+    """
+    try:
+        return memoryview(payload)[start:end]
+    except TypeError:
+        return buffer(payload, start, end - start)
+
+
+class PartialPayload(object):
+    """
+    Payload of an object that has been passed on before it has been
+    received in full (cut-through forwarding).  The first 'received' bytes
+    of the spooled 'data' are valid; listeners are called without arguments
+    whenever more bytes arrive and when the payload is completed or failed.
+    """
+    def __init__(self, size, directory=None):
+        self.data = spool(size, directory)
+        self.size = size
+        self.received = 0
+        self.failed = False
+        self.listeners = []
+
+    def __len__(self):
+        return self.size
+
+    def complete(self):
+        return self.received >= self.size
+
+    def write(self, data):
+        self.data[self.received:self.received + len(data)] = data
+        self.received += len(data)
+        self._notify()
+
+    def fail(self):
+        self.failed = True
+        self._notify()
+
+    def _notify(self):
+        for listener in list(self.listeners):
+            listener()
+
+
+class Decoder(object):
+    """
+    Push-based decoder state machine.  It is either looking for the NUL
+    terminating the metadata or, once the metadata has been parsed, filling
+    the payload of the current object.
+
+    Payloads larger than spool_threshold bytes are spooled (see spool()).
+    Objects whose payload is larger than cut_through_threshold bytes are
+    returned as soon as their metadata is decoded, with a PartialPayload;
+    once it is complete, the payload of the object is replaced with the
+    spooled data.  Both are disabled when None.
+
+    Compressed payloads may inflate to at most max_inflated_bytes bytes;
+    with None they aren't accepted at all.
+    """
+    def __init__(self, max_metadata_bytes=_MAX_METADATA_BYTES, spool_threshold=None,
+                 cut_through_threshold=None, spool_directory=None,
+                 max_inflated_bytes=_MAX_INFLATED_BYTES):
+        self.max_metadata_bytes = max_metadata_bytes
+        self.max_inflated_bytes = max_inflated_bytes
+        self.spool_threshold = spool_threshold
+        self.cut_through_threshold = cut_through_threshold
+        self.spool_directory = spool_directory
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.scanned = 0
+
+        self.metadata = None
+        self.payload = None
+        self.received = 0
+        self.started = None
+
+    def partial(self):
+        """
+        True if the decoder holds bytes of an object that isn't complete yet.
+        """
+        return self.metadata is not None or self.position < len(self.buffer)
+
+    def close(self):
+        """
+        Discards the object being decoded; a partial payload that has already
+        been passed on is marked as failed.
+        """
+        if isinstance(self.payload, PartialPayload):
+            self.payload.fail()
+        self.metadata = None
+        self.payload = None
+        self.received = 0
+        self.started = None
+        self.buffer = bytearray()
+        self.position = self.scanned = 0
+
+    def feed(self, data):
+        """
+        Feeds received bytes to the decoder and returns a list of the objects
+        completed by them.  Raises InvalidMetadata if the metadata of an
+        object can't be parsed; the decoder continues after the broken
+        metadata on the next call.
+        """
+        objects = []
+        offset = 0
+
+        if self.metadata is not None:
+            offset = min(len(data), self.payload_size() - self.received)
+            self._write_payload(data[:offset])
+            objects.extend(self.payload_received(0))
+            if self.metadata is not None:
+                return objects
+
+        if offset == 0:
+            self.buffer.extend(data)
+        elif offset < len(data):
+            self.buffer.extend(data[offset:])
+
+        try:
+            self._decode(objects)
+        finally:
+            self._compact()
+        return objects
+
+    def payload_size(self):
+        return self.metadata['size']
+
+    def payload_view(self):
+        """
+        Returns a writable memoryview of the part of the current payload that
+        hasn't been received yet (or None when not reading a payload into
+        memory), so that large payloads can be received in place with
+        recv_into().  Call payload_received() with the number of bytes
+        written.
+        """
+        if self.metadata is None or not isinstance(self.payload, bytearray):
+            return None
+        return memoryview(self.payload)[self.received:]
+
+    def payload_received(self, count):
+        self.received += count
+        if self.received < self.payload_size():
+            return []
+
+        metadata, payload, started = self.metadata, self.payload, self.started
+        self.metadata = None
+        self.payload = None
+        self.received = 0
+        self.started = None
+
+        if started is not None:
+            started.payload = payload.data
+            return []
+        return [_make_object(metadata, payload, self.max_inflated_bytes)]
+
+    def _write_payload(self, data):
+        if isinstance(self.payload, bytearray):
+            self.payload[self.received:self.received + len(data)] = data
+        elif isinstance(self.payload, PartialPayload):
+            self.payload.write(bytes(data))
+        else:
+            self.payload[self.received:self.received + len(data)] = bytes(data)
+        self.received += len(data)
+
+    def _start_payload(self, metadata, size, objects):
+        if self.cut_through_threshold is not None and size > self.cut_through_threshold and \
+           'payload-compression' not in metadata:
+            self.payload = PartialPayload(size, self.spool_directory)
+            self.started = BusinessObject(metadata, self.payload)
+            objects.append(self.started)
+        elif self.spool_threshold is not None and size > self.spool_threshold:
+            self.payload = spool(size, self.spool_directory)
+        else:
+            self.payload = bytearray(size)
+        self.metadata = metadata
+        self.received = 0
+
+    def _next_metadata(self):
+        """
+        Returns the metadata of the next frame, or None if the metadata
+        hasn't been received in full yet.
+        """
+        buffer = self.buffer
+        if self.position < len(buffer) and buffer[self.position] == _BINARY_MARKER:
+            if len(buffer) - self.position < _BINARY_HEADER_BYTES:
+                return None
+            length = _BINARY_LENGTH.unpack_from(buffer, self.position + 1)[0]
+            if length > self.max_metadata_bytes:
+                raise InvalidMetadata("Metadata longer than %i bytes" %
+                                      self.max_metadata_bytes)
+            start = self.position + _BINARY_HEADER_BYTES
+            if len(buffer) < start + length:
+                return None
+
+            self.position = self.scanned = start + length
+            return self._parse_binary_metadata(buffer[start:start + length])
+
+        index = buffer.find('\x00', self.scanned)
+        if index < 0:
+            self.scanned = len(buffer)
+            if self.scanned - self.position > self.max_metadata_bytes:
+                self.position = self.scanned
+                raise InvalidMetadata("Metadata longer than %i bytes" %
+                                      self.max_metadata_bytes)
+            return None
+
+        raw = buffer[self.position:index]
+        self.position = self.scanned = index + 1
+        return self._parse_metadata(raw)
+
+    def _decode(self, objects):
+        buffer = self.buffer
+        while True:
+            metadata = self._next_metadata()
+            if metadata is None:
+                return
+
+            size = metadata.get('size', 0)
+            if not isinstance(size, (int, long)) or size < 0:
+                raise InvalidMetadata("Invalid size %r" % (size, ))
+
+            if size == 0:
+                objects.append(BusinessObject(metadata, None))
+                continue
+
+            available = len(buffer) - self.position
+            if available >= size and (self.spool_threshold is None or
+                                      size <= self.spool_threshold):
+                payload = buffer[self.position:self.position + size]
+                self.position = self.scanned = self.position + size
+                objects.append(_make_object(metadata, payload, self.max_inflated_bytes))
+                continue
+
+            self._start_payload(metadata, size, objects)
+            used = min(available, size)
+            self._write_payload(buffer[self.position:self.position + used])
+            self.position = self.scanned = self.position + used
+            if self.received < size:
+                return
+            objects.extend(self.payload_received(0))
+
+    def _parse_metadata(self, raw):
+        try:
+            metadata = jsoncodec.loads(raw)
+        except ValueError, ve:
+            raise InvalidMetadata(u"Couldn't load JSON from '{0}'".format(_snippet(raw)))
+
+        if not isinstance(metadata, dict):
+            raise InvalidMetadata(u"Metadata is not a JSON object: '{0}'".format(_snippet(raw)))
+        return metadata
+
+    def _parse_binary_metadata(self, raw):
+        if msgpack is None:
+            raise InvalidMetadata("Received binary metadata but msgpack isn't available")
+
+        try:
+            metadata = msgpack.unpackb(bytes(raw), raw=False)
+        except Exception, e:
+            raise InvalidMetadata(u"Couldn't unpack binary metadata: {0}".format(e))
+
+        if not isinstance(metadata, dict):
+            raise InvalidMetadata(u"Binary metadata is not a map")
+        return metadata
+
+    def _compact(self):
+        if self.position >= len(self.buffer):
+            self.buffer = bytearray()
+            self.position = self.scanned = 0
+        elif self.position > 0:
+            del self.buffer[:self.position]
+            self.scanned -= self.position
+            self.position = 0
+
+
+def _inflated_completely(inflater):
+    """
+    Tells whether the deflate stream ended exactly at the end of the input.
+    Python 2 has no decompressobj.eof, but past the end of the stream any
+    input is left over in unused_data.
+    """
+    if len(inflater.unused_data) > 0:
+        return False
+    probe = inflater.copy()
+    try:
+        probe.decompress('\x00')
+    except zlib.error, e:
+        return False
+    return len(probe.unused_data) > 0
+
+def _make_object(metadata, payload, max_inflated_bytes):
+    """
+    Creates a received object, inflating its payload if it was compressed
+    for the link (see CompressingEncoder).
+    """
+    if 'payload-compression' not in metadata:
+        return BusinessObject(metadata, payload)
+
+    compression = metadata.pop('payload-compression')
+    if max_inflated_bytes is None:
+        raise InvalidObject(u"Compressed payload on a connection that didn't ask for it")
+    if compression != _COMPRESSION:
+        raise InvalidObject(u"Unknown payload compression {0}".format(compression))
+    inflater = zlib.decompressobj()
+    try:
+        payload = bytearray(inflater.decompress(buffer(payload), max_inflated_bytes))
+    except zlib.error, e:
+        raise InvalidObject(u"Couldn't inflate payload: {0}".format(e))
+    if len(inflater.unconsumed_tail) > 0:
+        raise InvalidObject(u"Payload inflates to more than {0} bytes".format(
+            max_inflated_bytes))
+    if not _inflated_completely(inflater):
+        raise InvalidObject(u"Compressed payload is truncated or followed by garbage")
+    if len(inflater.flush()) > 0:
+        raise InvalidObject(u"Payload inflates to more than {0} bytes".format(
+            max_inflated_bytes))
+    metadata['size'] = len(payload)
+    return BusinessObject(metadata, payload)
+
+def _snippet(raw):
+    snippet = raw.decode('utf-8', 'replace')
+    if len(snippet) > 100:
+        snippet = snippet[0:75] + u"..."
+    return snippet
+
+
+class Encoder(object):
+    """
+    Encodes objects to the wire format.  The id, size and type attributes of
+    the object are written to its metadata before encoding.
+
+    Encoded metadata is cached in the object, keyed by the encoder name and
+    the version of the metadata, so an object multiplexed to many clients is
+    encoded once and re-encoded only if its metadata changes.  The cached
+    header is an immutable string shared by all recipients.
+    """
+    name = 'json'
+
+    def _encode_metadata(self, metadata):
+        return jsoncodec.dumpb(metadata) + '\x00'
+
+    def encode_metadata(self, obj):
+        obj.sync_metadata()
+        metadata = obj.metadata
+
+        if obj.encoded is None:
+            obj.encoded = {}
+        else:
+            cached = obj.encoded.get(self.name, None)
+            if cached is not None and cached[0] == metadata.version:
+                return cached[1]
+
+        ret = self._encode_metadata(metadata)
+        obj.encoded[self.name] = (metadata.version, ret)
+        return ret
+
+    def options(self):
+        """
+        Returns the subscription options this encoder was negotiated with.
+        """
+        return {'metadata-encoding': self.name}
+
+    def buffers(self, obj):
+        """
+        Returns the encoded metadata and the payload as separate buffers.
+        """
+        header = self.encode_metadata(obj)
+        if obj.size > 0:
+            return [header, obj.payload]
+        return [header]
+
+    def encode(self, obj):
+        ret = bytearray(self.encode_metadata(obj))
+        if obj.size > 0:
+            ret.extend(obj.payload)
+        return ret
+
+
+class MsgpackEncoder(Encoder):
+    """
+    Encodes metadata with MessagePack.  A binary frame starts with a marker
+    byte that can't start JSON metadata and the length of the packed
+    metadata, so Decoder tells the two apart frame by frame.
+    """
+    name = 'msgpack'
+
+    def _encode_metadata(self, metadata):
+        packed = msgpack.packb(metadata, use_bin_type=False)
+        return _BINARY_MARKER_BYTE + _BINARY_LENGTH.pack(len(packed)) + packed
+
+default_encoder = Encoder()
+
+encoders = {default_encoder.name: default_encoder}
+if msgpack is not None:
+    encoders[MsgpackEncoder.name] = MsgpackEncoder()
+
+
+class CompressingEncoder(Encoder):
+    """
+    Wraps another encoder and deflates payloads of at least threshold bytes
+    whose type matches one of types ('text/*' matches any text).  The frame
+    of a compressed object has the compressed size and 'payload-compression'
+    in its metadata; Decoder inflates it again.
+
+    The compressed payload is cached in the object, so an object sent over
+    many compressed links is compressed once.  Payloads that don't shrink,
+    and payloads still being received (cut-through), are sent as they are.
+    """
+    def __init__(self, encoder=default_encoder, threshold=_COMPRESSION_THRESHOLD,
+                 types=_COMPRESSIBLE_TYPES):
+        self.encoder = encoder
+        self.threshold = threshold
+        self.types = types
+        self.patterns = []
+        for pattern in types:
+            main, sub = pattern.split('/', 1)
+            self.patterns.append((main, sub))
+        self.name = '{0}+{1}'.format(encoder.name, _COMPRESSION)
+
+    def compressible(self, obj):
+        if obj.size < self.threshold or isinstance(obj.payload, PartialPayload) or \
+           obj.content_type is None:
+            return False
+
+        content_type = obj.content_type
+        for main, sub in self.patterns:
+            if main == content_type.content_type and sub in ('*', content_type.subtype):
+                return True
+        return False
+
+    def compressed_payload(self, obj):
+        """
+        Returns the compressed payload of the object, or None if it's sent
+        uncompressed.
+        """
+        if not self.compressible(obj):
+            return None
+
+        if obj.encoded is None:
+            obj.encoded = {}
+        cached = obj.encoded.get(_COMPRESSION, None)
+        if cached is not None and cached[0] is obj.payload:
+            return cached[1]
+
+        compressed = zlib.compress(buffer(obj.payload, 0, obj.size))
+        if len(compressed) >= obj.size:
+            compressed = None
+        obj.encoded[_COMPRESSION] = (obj.payload, compressed)
+        return compressed
+
+    def options(self):
+        ret = self.encoder.options()
+        ret['payload-compression'] = _COMPRESSION
+        return ret
+
+    def _encode_metadata(self, metadata):
+        return self.encoder._encode_metadata(metadata)
+
+    def encode_metadata(self, obj):
+        compressed = self.compressed_payload(obj)
+        if compressed is None:
+            return self.encoder.encode_metadata(obj)
+
+        obj.sync_metadata()
+        cached = obj.encoded.get(self.name, None)
+        if cached is not None and cached[0] == obj.metadata.version:
+            return cached[1]
+
+        metadata = dict(obj.metadata)
+        metadata['size'] = len(compressed)
+        metadata['payload-compression'] = _COMPRESSION
+        ret = self._encode_metadata(metadata)
+        obj.encoded[self.name] = (obj.metadata.version, ret)
+        return ret
+
+    def buffers(self, obj):
+        header = self.encode_metadata(obj)
+        compressed = self.compressed_payload(obj)
+        if compressed is not None:
+            return [header, compressed]
+        return self.encoder.buffers(obj)
+
+    def encode(self, obj):
+        return bytearray().join(self.buffers(obj))
+
+_compressing_encoders = {}
+
+def negotiate_encoder(requested, compression=None, compression_threshold=None,
+                      compression_types=None):
+    """
+    Returns the first available encoder of the requested metadata encoding
+    name (or list of names), falling back to JSON.  If compression_threshold
+    is given and 'deflate' is among the requested payload compressions, the
+    encoder also compresses payloads of compression_types (by default text,
+    JSON, JavaScript and XML; see CompressingEncoder).
+    """
+    if isinstance(requested, basestring):
+        requested = [requested]
+    if isinstance(compression, basestring):
+        compression = [compression]
+
+    encoder = default_encoder
+    for name in requested or []:
+        if name in encoders:
+            encoder = encoders[name]
+            break
+
+    if compression_threshold is None or _COMPRESSION not in (compression or []):
+        return encoder
+
+    if compression_types is None:
+        compression_types = _COMPRESSIBLE_TYPES
+    key = (encoder.name, compression_threshold, tuple(compression_types))
+    if key not in _compressing_encoders:
+        _compressing_encoders[key] = CompressingEncoder(encoder, compression_threshold,
+                                                        tuple(compression_types))
+    return _compressing_encoders[key]
+
+
+def _coalesce(buffers, limit=_COALESCE_BYTES):
+    """
+    Joins runs of small adjacent buffers (a header and a short payload, say)
+    so that they go out in one send(); buffers of limit bytes or more are
+    passed through as they are.  So are memory maps and other buffers that
+    bytearray.join() doesn't take, whatever their size.
+    """
+    run = []
+    run_size = 0
+    for buffer in buffers:
+        joinable = len(buffer) < limit and isinstance(buffer, (str, bytearray))
+        if not joinable or run_size + len(buffer) > limit:
+            if len(run) == 1:
+                yield run[0]
+            elif len(run) > 1:
+                yield bytearray().join(run)
+            run = []
+            run_size = 0
+
+        if not joinable:
+            yield buffer
+        else:
+            run.append(buffer)
+            run_size += len(buffer)
+
+    if len(run) == 1:
+        yield run[0]
+    elif len(run) > 1:
+        yield bytearray().join(run)
+
+def _send_all(socket, data):
+    length = len(data)
+    sent_total = 0
+    while sent_total < length:
+        sent = socket.send(payload_slice(data, sent_total, length))
+        if sent == 0:
+            raise RuntimeError("socket connection broken")
+        sent_total += sent
+    return sent_total
+
+def send_buffers(socket, buffers):
+    """
+    Writes the buffers to the socket in order without concatenating large
+    ones; partial writes are resumed through memoryview slices, so payloads
+    are never copied.  Returns the number of bytes sent.
+    """
+    sent_total = 0
+    for buffer in _coalesce(buffers):
+        sent_total += _send_all(socket, buffer)
+    return sent_total
+
+
+class SocketReader(object):
+    """
+    Reads objects from one connection.  The socket is read in large chunks
+    and everything past the current object is kept for the next read; large
+    payloads are received directly into the payload buffer.  Keyword
+    arguments are passed on to the Decoder.
+
+    Objects that have already been decoded are invisible to select(), so
+    callers that select() on the socket should check pending() first.
+    """
+    def __init__(self, socket, chunk_size=_CHUNK_SIZE, **decoder_options):
+        self.socket = socket
+        self.chunk_size = chunk_size
+        self.decoder = Decoder(**decoder_options)
+        self.objects = deque()
+
+    def pending(self):
+        return len(self.objects) > 0
+
+    def partial(self):
+        return self.decoder.partial()
+
+    def _closed_while_reading(self):
+        self.decoder.close()
+        raise InvalidObject("Connection closed while reading object from %s" %
+                            str(self.socket))
+
+    def receive(self):
+        """
+        Reads from the socket once and returns the list of objects completed
+        by the bytes read, which may be empty.  Returns None if the
+        connection was closed between objects.
+        """
+        if len(self.objects) > 0:
+            ret = list(self.objects)
+            self.objects.clear()
+            return ret
+
+        view = self.decoder.payload_view()
+        if view is not None and len(view) >= self.chunk_size:
+            received = self.socket.recv_into(view)
+            if received == 0:
+                self._closed_while_reading()
+            return self.decoder.payload_received(received)
+
+        data = self.socket.recv(self.chunk_size)
+        if len(data) == 0:
+            if self.decoder.partial():
+                self._closed_while_reading()
+            return None
+        return self.decoder.feed(data)
+
+    def read_object(self, last_activity_timeout_secs=5, read_timeout_secs=120):
+        """
+        Returns the next object or None if the connection was closed between
+        objects.
+        """
+        now = time()
+        deadline = now + read_timeout_secs
+        last_activity = now
+
+        while len(self.objects) == 0:
+            now = time()
+            if now > last_activity + last_activity_timeout_secs or now > deadline:
+                self.decoder.close()
+                raise InvalidObject("Timed out while reading from %s" % str(self.socket))
+
+            objects = self.receive()
+            if objects is None:
+                return None
+            self.objects.extend(objects)
+            last_activity = now
+
+        return self.objects.popleft()
+
+
+_readers = WeakKeyDictionary()
+
+def reader_for(socket):
+    """
+    Returns the SocketReader for the socket, creating it on first use so that
+    bytes buffered while reading one object aren't lost for the next one.
+    """
+    if isinstance(socket, SocketReader):
+        return socket
+
+    reader = _readers.get(socket, None)
+    if reader is None:
+        reader = SocketReader(proxy(socket))
+        _readers[socket] = reader
+    return reader
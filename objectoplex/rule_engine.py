@@ -29,7 +29,44 @@ function message_passed_by_subscription_rules(msg, subscription_rules)
   end
   return pass
 end
+
+Rule lists are compiled once (compile_rules) and their decisions are
+memoized by the type, event and natures of the message.
 """
+from collections import OrderedDict
+
+_DECISION_CACHE_SIZE = 4096
+_RULES_CACHE_SIZE = 1024
+_RECIPIENTS_CACHE_SIZE = 1024
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+_decisions = LRUCache(_DECISION_CACHE_SIZE)
+_compiled_rules = LRUCache(_RULES_CACHE_SIZE)
 
 def match(matcher, matchable):
     if matcher is None or matchable is None:
@@ -52,26 +89,189 @@ def match(matcher, matchable):
 
 
 def routing_decision(message, rules):
-    PASS = False # pass written in lowercase is a keyword in Python
+    return compile_rules(rules).passes(message)
+
+def message_key(message):
+    """
+    Returns what routing decisions depend on, (type, event, natures), or
+    None if it can't be used as a key.
+    """
+    natures = message.metadata.get('natures', [])
+    if not isinstance(natures, (list, tuple)):
+        return None
+    key = (message.metadata.get('type', None), message.event, tuple(natures))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def compile_rules(rules):
+    """
+    Returns the Rules for a list of subscription rules; equal lists share
+    one.
+    """
+    try:
+        key = tuple(rules)
+        hash(key)
+    except TypeError:
+        return Rules(rules)
+
+    compiled = _compiled_rules.get(key)
+    if compiled is None:
+        compiled = Rules(key)
+        _compiled_rules.put(key, compiled)
+    return compiled
+
+
+class Rules(object):
+    """
+    A list of subscription rules parsed once.  passes() memoizes its
+    decisions in an LRU cache shared by all rule lists.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.parsed = [parse_rule(rule) for rule in rules if isinstance(rule, basestring)]
+
+    def passes(self, message):
+        key = message_key(message)
+        if key is None:
+            return self.decide(message.metadata.get('type', None), message.event,
+                               message.metadata.get('natures', []))
+
+        decision = _decisions.get((self, key))
+        if decision is None:
+            decision = self.decide(*key)
+            _decisions.put((self, key), decision)
+        return decision
+
+    def decide(self, content_type, event, natures):
+        type_parts = _parts(content_type)
+        event_parts = _parts(event)
+        nature_parts = [_parts(nature) for nature in natures]
+
+        PASS = False
+        for positive, kind, prefix in self.parsed:
+            if kind == 'any':
+                PASS = positive
+            elif kind == 'type':
+                if type_parts is not None and type_parts[:len(prefix)] == prefix:
+                    PASS = positive
+            elif kind == 'event':
+                if event_parts is not None and event_parts[:len(prefix)] == prefix:
+                    PASS = positive
+            else:
+                for parts in nature_parts:
+                    if parts is not None and parts[:len(prefix)] == prefix:
+                        PASS = positive
+                        break
+        return PASS
+
+def _parts(matchable):
+    if not isinstance(matchable, basestring):
+        return None
+    return tuple(matchable.split('/'))
+
+def parse_rule(rule):
+    """
+    Returns (positive, kind, prefix) for a subscription rule.  kind is
+    'type', 'event' or 'nature', or 'any' for the rule '*' that also passes
+    objects without a type.  The rule matches the strings whose parts
+    (split at '/') start with prefix, as match() does.
+    """
+    positive = not rule.startswith('!')
+    if not positive:
+        rule = rule[1:]
+
+    if rule.startswith('#'):
+        kind, rule = 'nature', rule[1:]
+    elif rule.startswith('@'):
+        kind, rule = 'event', rule[1:]
+    elif rule == '*':
+        return positive, 'any', ()
+    else:
+        kind = 'type'
+
+    parts = rule.split('/')
+    if '*' in parts:
+        parts = parts[:parts.index('*')]
+    return positive, kind, tuple(parts)
+
+def prefixes(matchable):
+    parts = matchable.split('/')
+    return [tuple(parts[:length]) for length in xrange(len(parts) + 1)]
+
+
+class SubscriptionIndex(object):
+    """
+    Subscription rules of clients indexed by the prefix they match.
+    recipients() gives the clients routing_decision() would pass an object
+    to, looking up only the rules that could match it.
+    """
+    def __init__(self):
+        # (kind, prefix) -> {client: [(position of rule, positive), ...]}
+        self.buckets = {}
+        self.keys = {}
+        # Recipients by message_key(), until the index changes.
+        self.cache = LRUCache(_RECIPIENTS_CACHE_SIZE)
+
+    def update(self, client, rules):
+        """
+        rules is a list of rules or the Rules compiled from it.
+        """
+        self.remove(client)
+        if not isinstance(rules, Rules):
+            rules = compile_rules(rules)
+
+        keys = set()
+        for position, (positive, kind, prefix) in enumerate(rules.parsed):
+            key = (kind, prefix)
+            self.buckets.setdefault(key, {}).setdefault(client, []).append((position, positive))
+            keys.add(key)
+        self.keys[client] = keys
+
+    def remove(self, client):
+        self.cache.clear()
+        for key in self.keys.pop(client, ()):
+            bucket = self.buckets[key]
+            del bucket[client]
+            if len(bucket) == 0:
+                del self.buckets[key]
+
+    def recipients(self, message):
+        key = message_key(message)
+        if key is None:
+            return self._recipients(message)
 
-    for rule in rules:
-        is_negative_rule = rule.startswith('!')
-        if is_negative_rule:
-            rule = rule[1:]
+        recipients = self.cache.get(key)
+        if recipients is None:
+            recipients = self._recipients(message)
+            self.cache.put(key, recipients)
+        return recipients
 
-        if rule.startswith('#'):
-            rule = rule[1:]
-            for nature in message.metadata.get('natures', []):
-                if match(rule, nature): # nature == rule:
-                    PASS = not is_negative_rule
-                    break
+    def _recipients(self, message):
+        # The last matching rule of a client decides.
+        last = {}
 
-        elif rule.startswith('@'):
-            rule = rule[1:]
-            if message.event is not None and match(rule, message.event): # message.event == rule:
-                PASS = not is_negative_rule
+        def collect(key):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return
+            for client, matches in bucket.iteritems():
+                if matches[-1] > last.get(client, (-1, False)):
+                    last[client] = matches[-1]
 
-        elif rule == '*' or match(rule, message.metadata.get('type', None)):
-            PASS = not is_negative_rule
+        collect(('any', ()))
+        content_type = message.metadata.get('type', None)
+        if isinstance(content_type, basestring):
+            for prefix in prefixes(content_type):
+                collect(('type', prefix))
+        if message.event is not None:
+            for prefix in prefixes(message.event):
+                collect(('event', prefix))
+        for nature in message.metadata.get('natures', []):
+            if isinstance(nature, basestring):
+                for prefix in prefixes(nature):
+                    collect(('nature', prefix))
 
-    return PASS
+        return tuple(client for client, (position, positive) in last.iteritems() if positive)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+A single greenlet running all timers of a server from a heap, sleeping until
+the next one is due instead of waking up at fixed intervals.
+"""
+import heapq
+import logging
+import traceback
+
+from itertools import count
+from time import time
+
+from gevent import Greenlet
+from gevent.event import Event
+
+logger = logging.getLogger('scheduler')
+
+
+class Scheduled(object):
+    """
+    A timer returned by Scheduler; cancel() it if it's no longer needed.
+    """
+    __slots__ = ['deadline', 'interval', 'callback', 'args', 'cancelled']
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(Greenlet):
+    """
+    Calls callbacks at given times.  Cancelled timers are dropped from the
+    heap only when they come up.  Exceptions raised by callbacks are logged.
+    """
+    def __init__(self):
+        Greenlet.__init__(self)
+        self.heap = []
+        self.counter = count()
+        self.wakeup = Event()
+
+    def call_at(self, deadline, callback, *args):
+        return self._push(Scheduled(deadline, None, callback, args))
+
+    def call_later(self, delay, callback, *args):
+        return self._push(Scheduled(time() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        """
+        Calls callback every interval seconds, the first time after one
+        interval.
+        """
+        return self._push(Scheduled(time() + interval, interval, callback, args))
+
+    def _push(self, scheduled):
+        if len(self.heap) == 0 or scheduled.deadline < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (scheduled.deadline, next(self.counter), scheduled))
+        return scheduled
+
+    def _run(self):
+        logger.info(u"Scheduler greenlet started")
+
+        while True:
+            self.wakeup.clear()
+            if len(self.heap) == 0:
+                self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - time()
+            if delay > 0:
+                self.wakeup.wait(delay)
+                continue
+
+            deadline, order, scheduled = heapq.heappop(self.heap)
+            if scheduled.cancelled:
+                continue
+
+            try:
+                scheduled.callback(*scheduled.args)
+            except KeyboardInterrupt, kbi:
+                raise kbi
+            except Exception, e:
+                traceback.print_exc()
+                logger.error(u"Got {0} while calling {1}!".format(e, scheduled.callback))
+
+            if scheduled.interval is not None and not scheduled.cancelled:
+                scheduled.deadline = max(deadline + scheduled.interval, time())
+                self._push(scheduled)
@@ -5,10 +5,11 @@ This module implements the machinery to run servers.
 
 import errno
 import logging
+import os
 import signal
 import traceback
 
-from datetime import datetime, timedelta
+from time import time
 
 import gevent
 
@@ -18,11 +19,46 @@ from gevent import socket
 from gevent import sleep
 from gevent.select import select
 from gevent.queue import Queue, Empty
+from gevent.event import Event
 
 from system import BusinessObject, ObjectType, InvalidObject
+from protocol import SocketReader, PartialPayload, default_encoder, send_buffers, payload_slice
+from backpressure import SendQueue
+from scheduler import Scheduler
 
 logger = logging.getLogger('server')
 
+_PAYLOAD_WAIT_SECS = 120.0
+_SERVER_INACTIVITY_SECS = 30 * 60.0
+_BATCH_OBJECTS = 64
+_BATCH_BYTES = 256 * 1024
+
+def send_partial(obj, socket, encoder=default_encoder, timeout_secs=_PAYLOAD_WAIT_SECS):
+    """
+    Sends an object whose payload is still being received (cut-through),
+    sending each part of the payload as soon as it has arrived.
+    """
+    payload = obj.payload
+    arrived = Event()
+    payload.listeners.append(arrived.set)
+    try:
+        send_buffers(socket, [encoder.encode_metadata(obj)])
+        sent = 0
+        while sent < payload.size:
+            if payload.failed:
+                raise InvalidObject(u"Payload of {0} was cut short".format(obj))
+
+            available = payload.received
+            if sent < available:
+                sent += send_buffers(socket, [payload_slice(payload.data, sent, available)])
+                continue
+
+            arrived.clear()
+            if not arrived.wait(timeout_secs):
+                raise InvalidObject(u"Timed out waiting for the payload of {0}".format(obj))
+    finally:
+        payload.listeners.remove(arrived.set)
+
 
 class Sender(Greenlet):
     def __init__(self, client):
@@ -35,19 +71,63 @@ class Sender(Greenlet):
 
         while True:
             try:
-                obj = client.queue.get(timeout=30.0)
-                size, sent = obj.serialize(socket=client.socket)
-                logger.debug(u">> {0}: {1}".format(client, obj))
-                # logger.debug(u"Sent {0}/{1} of {2}".format(sent, size, obj))
-            except Empty, empty:
-                pass
+                obj = client.queue.get()
+                while obj is not None:
+                    if isinstance(obj.payload, PartialPayload):
+                        send_partial(obj, client.socket, client.encoder)
+                        logger.debug(u">> {0}: {1}".format(client, obj))
+                        obj = None
+                    else:
+                        obj = self._send_batch(obj)
+            except InvalidObject, ivo:
+                client.close(u"{0}".format(ivo))
+                return
             except socket.error, e:
                 client.close(u"{0}".format(e))
                 return
             except IOError, ioe:
-                client.close(u"{0}".format(e))
+                client.close(u"{0}".format(ioe))
+                return
+            except Exception, e:
+                # Metadata that can't be encoded (from a msgpack peer, say)
+                # would otherwise leave the client without a Sender.
+                traceback.print_exc()
+                client.close(u"error while sending: {0}".format(e))
                 return
 
+    def _send_batch(self, obj):
+        """
+        Sends the object together with whatever else is already queued, up to
+        _BATCH_OBJECTS objects or _BATCH_BYTES bytes, in one vectored write.
+        Nothing is waited for, so a lone object goes out immediately.
+
+        Returns the object with a partial payload that ended the batch, if
+        any; it has to be sent on its own.
+        """
+        client = self.client
+        buffers = []
+        size = 0
+        count = 0
+        while obj is not None:
+            for buffer in client.encoder.buffers(obj):
+                buffers.append(buffer)
+                size += len(buffer)
+            count += 1
+            logger.debug(u">> {0}: {1}".format(client, obj))
+
+            obj = None
+            if count >= _BATCH_OBJECTS or size >= _BATCH_BYTES:
+                break
+            try:
+                obj = client.queue.get_nowait()
+            except Empty, empty:
+                break
+            if isinstance(obj.payload, PartialPayload):
+                break
+
+        send_buffers(client.socket, buffers)
+        return obj
+
 
 class Receiver(Greenlet):
     def __init__(self, client):
@@ -58,25 +138,21 @@ class Receiver(Greenlet):
         client = self.client
         logger.info(u"Receiver handling connection from {0}".format(client.address))
 
-        last_activity = datetime.now()
         while True:
-            if client.server and last_activity + timedelta(minutes=30) < datetime.now():
-                client.close('inactivity')
-                return
-
-            rlist, wlist, xlist = select([client.socket], [], [], timeout=30.0)
+            # Timeouts are enforced by SystemClient.check_activity().
+            rlist, wlist, xlist = select([client.socket], [], [])
 
             if len(rlist) == 1:
                 # logger.debug(u"Attempting to read an object from {0}".format(self.socket))
                 try:
-                    obj = BusinessObject.read_from_socket(client.socket)
-                    if obj is None:
-                        client.close("couldn't read object")
+                    objects = client.reader.receive()
+                    if objects is None:
+                        client.close("connection closed")
                         return
-                    # logger.debug(u"Successfully read object {0}".format(str(obj)))
-                    logger.debug(u"<< {0}: {1}".format(client, obj))
-                    client.gateway.send(obj, client)
-                    last_activity = datetime.now()
+                    for obj in objects:
+                        logger.debug(u"<< {0}: {1}".format(client, obj))
+                        client.gateway.send(obj, client)
+                    client.last_activity = time()
                 except InvalidObject, ivo:
                     client.close(u"{0}".format(ivo))
                     return
@@ -84,38 +160,91 @@ class Receiver(Greenlet):
                     client.close(u"{0}".format(e))
                     return
                 except IOError, ioe:
-                    client.close(u"{0}".format(e))
+                    client.close(u"{0}".format(ioe))
                     return
 
 
 class SystemClient(object):
     def __init__(self, socket, address, gateway, server=False):
         self.socket = socket
+        self.reader = SocketReader(socket,
+                                   spool_threshold=gateway.spool_threshold,
+                                   cut_through_threshold=gateway.cut_through_threshold,
+                                   spool_directory=gateway.spool_directory,
+                                   max_inflated_bytes=None)
         self.address = address
         self.gateway = gateway
         self.server = server
-        self.queue = Queue(maxsize=100)
+        # Links between workers of the same server (see workers.py) aren't
+        # counted as clients.
+        self.worker_link = False
+        self.queue = SendQueue(gateway.backpressure,
+                               max_objects=gateway.queue_max_objects,
+                               max_bytes=gateway.queue_max_bytes,
+                               grace_secs=gateway.slow_consumer_grace_secs,
+                               spool_directory=gateway.spool_directory,
+                               on_slow_consumer=self.slow_consumer)
+        # Metadata encoding negotiated in routing/subscribe; JSON until then.
+        self.encoder = default_encoder
+        self.last_activity = time()
+        self.deadline = None
 
         self.receiver = Receiver(self)
         self.sender = Sender(self)
 
     def start(self):
+        self.last_activity = time()
+        self.deadline = self.gateway.scheduler.call_later(_PAYLOAD_WAIT_SECS, self.check_activity)
         self.receiver.start()
         self.sender.start()
 
+    def check_activity(self):
+        """
+        Called by the scheduler of the server.  Closes the client if nothing
+        has been received for _PAYLOAD_WAIT_SECS in the middle of an object
+        or, from a linked server, for _SERVER_INACTIVITY_SECS; otherwise
+        checks again when that could next be the case.
+        """
+        now = time()
+        idle = now - self.last_activity
+        if self.reader.partial() and idle > _PAYLOAD_WAIT_SECS:
+            self.close('timed out while reading object')
+            return
+        if self.server and idle > _SERVER_INACTIVITY_SECS:
+            self.close('inactivity')
+            return
+
+        next_check = self.last_activity + _PAYLOAD_WAIT_SECS
+        if next_check <= now:
+            next_check = now + _PAYLOAD_WAIT_SECS
+        self.deadline = self.gateway.scheduler.call_at(next_check, self.check_activity)
+
     def kill(self):
         if gevent.getcurrent() in [self.receiver, self.sender]:
             logger.error("SystemClient.kill() may not be called by the client's greenlets!")
             self.gateway.unregister(self)
             return
 
+        if self.deadline is not None:
+            self.deadline.cancel()
         self.receiver.kill()
         self.sender.kill()
         self.socket.close()
+        self.queue.close()
 
     def send(self, message, sender):
         self.queue.put(message)
 
+    def accept_compression(self):
+        """
+        Lets the peer send compressed payloads once deflate has been
+        negotiated in either direction.
+        """
+        self.reader.decoder.max_inflated_bytes = self.gateway.max_inflated_bytes
+
+    def slow_consumer(self):
+        self.close("slow consumer")
+
     def close(self, message=""):
         try:
             logger.warning(u"Closing connection to {0} due to {1}".format(self.address, message))
@@ -131,24 +260,54 @@ class SystemClient(object):
         return unicode(self).encode('ASCII', 'backslashreplace')
 
 
-class Timer(Greenlet):
-    def __init__(self, server):
-        Greenlet.__init__(self)
-        self.server = server
-
-    def _run(self):
-        logger.info(u"Timer greenlet started")
+def unix_listener(path, backlog=256):
+    """
+    Returns a Unix domain socket listening at path; a socket file left
+    behind by a previous server is removed.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
 
-        while True:
-            sleep(1)
 
-            for middleware in self.server.middlewares:
-                try:
-                    middleware.periodical(self.server.clients)
-                except KeyboardInterrupt, kbi:
-                    raise kbi
-                except Exception, e:
-                    logger.error(u"{0}".format(e))
+class SeenIds(object):
+    """
+    Ids of recently seen objects in two generations of sets.  When the
+    current one holds max_ids / 2 ids or is older than window_secs, it
+    becomes the previous one, so an id is remembered for at least
+    window_secs unless more than max_ids / 2 objects arrive in that time.
+    """
+    def __init__(self, window_secs=60.0, max_ids=100000):
+        self.window_secs = window_secs
+        self.max_ids = max_ids
+        self.current = set()
+        self.previous = set()
+        self.started = time()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, id):
+        """
+        Tells whether id has been seen before, remembering it.
+        """
+        try:
+            if id in self.current or id in self.previous:
+                self.hits += 1
+                return True
+        except TypeError, te:
+            return False
+
+        self.misses += 1
+        now = time()
+        if len(self.current) >= self.max_ids // 2 or now - self.started > self.window_secs:
+            self.previous = self.current
+            self.current = set()
+            self.started = now
+        self.current.add(id)
+        return False
 
 
 class ObjectoPlex(StreamServer):
@@ -156,38 +315,103 @@ class ObjectoPlex(StreamServer):
     ObjectoPlex is parameterized by giving a list of middleware classes.  The
     defaults are StatisticsMiddleware, ChecksumMiddleware and
     MultiplexingMiddleware.
+
+    Payloads larger than spool_threshold bytes are kept in memory mapped
+    temporary files (in spool_directory) instead of the heap.  Objects with
+    payloads larger than cut_through_threshold bytes are routed as soon as
+    their metadata has arrived and their payloads are forwarded while they
+    are being received; such objects get no sha1 from ChecksumMiddleware.
+
+    If compression_threshold is given, links to other servers, and clients
+    that ask for it, get payloads of at least that many bytes deflated if
+    their type is one of compression_types ('text/*' matches any text; by
+    default text, JSON, JavaScript and XML are compressed).  Compressed payloads are accepted only on such connections,
+    and only if they inflate to at most max_inflated_bytes bytes.
+
+    The send queue of each client holds at most queue_max_objects objects
+    and queue_max_bytes bytes of payload; backpressure names what happens
+    beyond that (see the backpressure module).  Clients may pick another
+    policy than 'block' in their subscription.
+
+    link_connections connections are opened to each of linked_servers
+    (see RoutingMiddleware for how objects are spread over them).
+
+    Objects arriving from linked servers are dropped if an object with the
+    same id has been seen in the last seen_ids_window_secs (see SeenIds),
+    so that meshed servers don't deliver objects twice.  None disables
+    this.
+
+    With unix_socket, the server also accepts connections at that path;
+    unix_socket_listener is a socket already listening there (inherited from
+    a previous server, see the handoff module).
     """
-    def __init__(self, listener, middlewares=[], linked_servers=[], **kwargs):
+    def __init__(self, listener, middlewares=[], linked_servers=[], spool_threshold=None,
+                 cut_through_threshold=None, spool_directory=None, compression_threshold=None,
+                 backpressure='drop-oldest', queue_max_objects=100, queue_max_bytes=None,
+                 slow_consumer_grace_secs=10.0, unix_socket=None, unix_socket_listener=None,
+                 link_connections=1, seen_ids_window_secs=60.0, seen_ids_max=100000,
+                 max_inflated_bytes=64*1024*1024, compression_types=None, **kwargs):
         StreamServer.__init__(self, listener, **kwargs)
+        # Middlewares get the immutable snapshot, which is rebuilt only when
+        # clients connect or disconnect; clients itself is never handed out.
         self.clients = set()
+        self.snapshot = frozenset()
+        self.snapshot_version = 0
+        self.spool_threshold = spool_threshold
+        self.cut_through_threshold = cut_through_threshold
+        self.spool_directory = spool_directory
+        self.compression_threshold = compression_threshold
+        self.compression_types = compression_types
+        self.max_inflated_bytes = max_inflated_bytes
+        self.backpressure = backpressure
+        self.queue_max_objects = queue_max_objects
+        self.queue_max_bytes = queue_max_bytes
+        self.slow_consumer_grace_secs = slow_consumer_grace_secs
+        self.unix_socket = unix_socket
+        self.unix_socket_listener = unix_socket_listener
+        self.unix_server = None
+        self.unlink_unix_socket = True
+        # Addresses of linked servers that are workers of this same server.
+        self.worker_links = set()
+        self.seen = None
+        if seen_ids_window_secs is not None:
+            self.seen = SeenIds(seen_ids_window_secs, seen_ids_max)
+        self.duplicates_dropped = 0
 
         from middleware import StatisticsMiddleware, MultiplexingMiddleware, ChecksumMiddleware
+        from middleware import Pipeline
         if len(middlewares) == 0:
             self.middlewares = [StatisticsMiddleware(),
                                 ChecksumMiddleware(),
                                 MultiplexingMiddleware()]
         else:
             self.middlewares = middlewares
+        self.pipeline = Pipeline(self.middlewares)
 
         self.link_to_servers = Queue()
         for linked_server in linked_servers:
-            self.link_to_servers.put(linked_server)
+            # Each connection is reopened on its own when it's lost.
+            for i in xrange(link_connections):
+                self.link_to_servers.put(linked_server)
         self.linker = Greenlet.spawn(self._linker)
 
         self.unregistrable = Queue()
         self.client_manager = Greenlet.spawn(self._client_manager)
 
-        self.timer = Timer(self)
-        self.timer.start()
+        # Timers of the middlewares and the clients.
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        for middleware in self.middlewares:
+            middleware.schedule(self)
 
     def _linker(self):
         while True:
             try:
                 host, port = self.link_to_servers.get(timeout=30.0)
                 server = self._open_link((host, port))
-                for middleware in self.middlewares:
+                for middleware in self.pipeline.connect:
                     try:
-                        middleware.connect(server, set(self.clients))
+                        middleware.connect(server, self.snapshot)
                     except Exception, e:
                         traceback.print_exc()
                         logger.error(u"Got {0} while calling {1}.connect!".format(e, middleware))
@@ -216,32 +440,57 @@ class ObjectoPlex(StreamServer):
         logger.info(u"Socket opened to {0}:{1}".format(*listener))
 
         client = SystemClient(sock, listener, self, server=True)
+        client.worker_link = listener in self.worker_links
 
-        self.clients.add(client)
+        self._add_client(client)
         client.host = listener[0]
         client.port = listener[1]
         client.start()
         logger.info(u"Connected to server at {0}:{1}".format(*listener))
         return client
 
-    def handle(self, source, address):
+    def start(self):
+        StreamServer.start(self)
+        if self.unix_socket is not None and self.unix_server is None:
+            listener = self.unix_socket_listener
+            if listener is None:
+                listener = unix_listener(self.unix_socket)
+            self.unix_server = StreamServer(listener, self._handle_unix)
+            self.unix_server.start()
+            logger.info(u"Listening at {0}".format(self.unix_socket))
+
+    def _handle_unix(self, source, address):
+        # Peers of Unix domain sockets have no address of their own.
+        self.handle(source, self.unix_socket)
+
+    def handle_worker_link(self, source, address):
+        self.handle(source, address, worker_link=True)
+
+    def handle(self, source, address, worker_link=False):
         client = SystemClient(source, address, self)
+        client.worker_link = worker_link
 
-        for middleware in self.middlewares:
+        for middleware in self.pipeline.connect:
             try:
-                middleware.connect(client, set(self.clients))
+                middleware.connect(client, self.snapshot)
             except Exception, e:
                 traceback.print_exc()
                 logger.error(u"Got {0} while calling {1}.connect!".format(e, middleware))
 
-        self.clients.add(client)
+        self._add_client(client)
 
         client.start()
 
     def send(self, message, sender):
-        for middleware in self.middlewares:
+        if self.seen is not None and self.seen.seen(message.id) and \
+           sender is not None and sender.server:
+            self.duplicates_dropped += 1
+            logger.debug(u"Dropped duplicate {0} from {1}".format(message, sender))
+            return
+
+        for middleware in self.pipeline.handlers(message):
             try:
-                message = middleware.handle(message, sender, set(self.clients))
+                message = middleware.handle(message, sender, self.snapshot)
                 if message is None:
                     break
             except Exception, e:
@@ -251,12 +500,24 @@ class ObjectoPlex(StreamServer):
     def unregister(self, client):
         self.unregistrable.put(client)
 
+    def _add_client(self, client):
+        self.clients.add(client)
+        self._update_snapshot()
+
+    def _update_snapshot(self):
+        self.snapshot = frozenset(self.clients)
+        self.snapshot_version += 1
+
     def _unregister(self, client):
+        # Both the sender and the receiver of a client may close it.
+        if client not in self.clients:
+            return
         self.clients.remove(client)
+        self._update_snapshot()
 
-        for middleware in self.middlewares:
+        for middleware in self.pipeline.disconnect:
             try:
-                middleware.disconnect(client, set(self.clients))
+                middleware.disconnect(client, self.snapshot)
             except Exception, e:
                 traceback.print_exc()
                 logger.error(u"Got {0} while calling {1}.disconnect!".format(e, middleware))
@@ -266,6 +527,21 @@ class ObjectoPlex(StreamServer):
         if client.server and hasattr(client, 'host'):
             self.link_to_servers.put((client.host, client.port))
 
+    def drain(self, timeout_secs=30.0):
+        """
+        Stops accepting connections and stops the server once everything
+        queued for the clients has been sent, or after timeout_secs.
+        """
+        self.stop_accepting()
+        if self.unix_server is not None:
+            self.unix_server.stop_accepting()
+
+        deadline = time() + timeout_secs
+        while time() < deadline and \
+              any(client.queue.qsize() > 0 for client in self.clients):
+            sleep(0.1)
+        self.stop()
+
     def stop(self, *args, **kwargs):
         for client in self.clients:
             try:
@@ -273,4 +549,14 @@ class ObjectoPlex(StreamServer):
             except:
                 pass
 
+        if self.unix_server is not None:
+            self.unix_server.stop()
+            self.unix_server = None
+            if self.unlink_unix_socket:
+                try:
+                    os.unlink(self.unix_socket)
+                except OSError, e:
+                    pass
+
+        self.scheduler.kill()
         return StreamServer.stop(self, *args, **kwargs)
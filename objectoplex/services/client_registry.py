@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
-import json
-
-from objectoplex import BusinessObject
+from objectoplex import BusinessObject, jsoncodec
 from objectoplex.services import Service
 
 
@@ -71,8 +69,7 @@ class ClientRegistry(Service):
                      'to': routing_id }
 
         reply = { 'clients': clients }
-        payload = bytearray(json.dumps(reply, ensure_ascii=False),
-                            encoding='utf-8')
+        payload = bytearray(jsoncodec.dumpb(reply))
         metadata['size'] = len(payload)
 
         return BusinessObject(metadata, payload)
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import traceback
-import json
 
 import requests
 
+import jsoncodec
+
 from system import BusinessObject
 from service import Service, timeout
 
@@ -38,8 +39,7 @@ class HttpHead(Service):
             if 'route' in obj.metadata:
                 metadata['to'] = obj.metadata['route'][0]
 
-            payload = bytearray(json.dumps(payload, ensure_ascii=False),
-                                encoding='utf-8')
+            payload = bytearray(jsoncodec.dumpb(payload))
             metadata['size'] = len(payload)
 
             reply = BusinessObject(metadata, payload)
@@ -6,6 +6,7 @@ import fcntl
 
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from random import uniform
 
 try:
     from gevent import socket
@@ -18,7 +19,7 @@ except ImportError, e:
     from Queue import Queue
     from time import sleep
 
-from objectoplex import BusinessObject, InvalidObject
+from objectoplex import BusinessObject, InvalidObject, SocketReader, connect
 
 
 @contextmanager
@@ -48,7 +49,7 @@ class _MetaService(type):
         service = getattr(t, '__service__', None)
 
         if service is not None:
-            clsdict['__slots__'] = ['__service__', 'host', 'port']
+            clsdict['__slots__'] = ['__service__', 'host', 'port', 'path']
             t = type.__new__(cls, clsname, clsbases, clsdict)  
             t.__service__ = service
 
@@ -56,11 +57,21 @@ class _MetaService(type):
 
 
 class Service(object):
+    """
+    After losing the connection, a service waits for a random time of up to
+    reconnect_min_secs, doubled for every failed attempt up to
+    reconnect_max_secs, so that services don't all reconnect at once when a
+    server restarts.
+    """
     __metaclass__ = _MetaService
 
-    def __init__(self, host, port, activity_timeout=60, args={}):
+    reconnect_min_secs = 1.0
+    reconnect_max_secs = 60.0
+
+    def __init__(self, host, port, activity_timeout=60, args={}, path=None):
         self.host = host
         self.port = port
+        self.path = path
         self.activity_timeout = activity_timeout
         self.logger = logging.getLogger(self.__class__.__service__)
         self.queue = Queue()
@@ -70,8 +81,13 @@ class Service(object):
         self.connect()
 
     def _open(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        self.socket = connect(self.host, self.port, path=self.path, socket=socket)
+        self.reader = SocketReader(self.socket)
+
+    def server_address(self):
+        if self.path is not None:
+            return self.path
+        return u"{0}:{1}".format(self.host, self.port)
 
     def subscribe(self):
         BusinessObject({ 'event': "routing/subscribe",
@@ -88,19 +104,22 @@ class Service(object):
                          self.__class__.__service__)
 
     def connect(self):
+        failures = 0
         while True:
             try:
                 self._open()
+                failures = 0
                 self.subscribe()
                 self.register()
                 self.receive()
             except socket.error, e:
-                self.logger.warning(u"{0}:{1}; {2}".format(self.host, self.port, e))
+                self.logger.warning(u"{0}; {1}".format(self.server_address(), e))
             except ConnectionTimeout, e:
-                self.logger.warning(u"{0}:{1}; {2}".format(self.host, self.port, e))
+                self.logger.warning(u"{0}; {1}".format(self.server_address(), e))
 
-            sleep_time = 10
-            self.logger.warning("Disconnected, sleeping for %i seconds!" % sleep_time)
+            sleep_time = self.reconnect_delay(failures)
+            failures += 1
+            self.logger.warning("Disconnected, sleeping for %.1f seconds!" % sleep_time)
             self.sleep(sleep_time)
             self.logger.info("Reconnecting...")
 
@@ -126,9 +145,12 @@ class Service(object):
                         obj = self.queue.get()
                         obj.serialize(socket=self.socket)
                 else:
-                    rlist, wlist, xlist = select.select([self.socket], [], [], 0.2)
+                    if self.reader.pending():
+                        rlist = [self.socket]
+                    else:
+                        rlist, wlist, xlist = select.select([self.socket], [], [], 0.2)
                     if len(rlist) > 0:
-                        obj = BusinessObject.read_from_socket(self.socket)
+                        obj = BusinessObject.read_from_socket(self.reader)
                         if obj is None:
                             raise InvalidObject
 
@@ -151,6 +173,10 @@ class Service(object):
                 self.socket.close()
                 raise kbi
 
+    def reconnect_delay(self, failures):
+        limit = min(self.reconnect_max_secs, self.reconnect_min_secs * 2 ** failures)
+        return uniform(0, limit)
+
     def should_handle(self, obj):
         if obj.event != 'services/request' or \
                obj.metadata.get('name', None) != self.__class__.__service__:
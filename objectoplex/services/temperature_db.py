@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import json
 import codecs
 
 import ConfigParser
@@ -14,7 +13,7 @@ Base = declarative_base()
 from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime
 from sqlalchemy.orm import sessionmaker
 
-from objectoplex import BusinessObject
+from objectoplex import BusinessObject, jsoncodec
 from objectoplex.services import Service
 
 
@@ -120,13 +119,13 @@ class TemperatureDB(Service):
         if error:
             reply = { 'error': str(error) }
 
-        payload = bytearray(json.dumps(reply, ensure_ascii=False), encoding='utf-8')
+        payload = bytearray(jsoncodec.dumpb(reply))
         metadata['size'] = len(payload)
 
         return BusinessObject(metadata, payload)
 
     def insert(self, obj):
-        payload = json.loads(obj.payload.decode('utf-8'))
+        payload = jsoncodec.loads(obj.payload)
 
         readings = []
 
@@ -140,7 +139,7 @@ class TemperatureDB(Service):
         return {u'status': 'Success!'}
 
     def last(self, obj):
-        payload = json.loads(obj.payload.decode('utf-8'))
+        payload = jsoncodec.loads(obj.payload)
         q = self.session.query(TemperatureReading).filter(TemperatureReading.sensor==payload['sensor'])
         q = q.order_by(TemperatureReading.created.desc())
         return q.first().to_dict()
@@ -3,44 +3,117 @@
 from __future__ import print_function
 
 import logging
-import json
 import re
 import io
 
 from os.path import getsize
 from mimetypes import guess_type
-from email.utils import make_msgid
+from itertools import count
+from uuid import uuid4
 from socket import socket as actual_socket
-from datetime import datetime, timedelta
+
+import jsoncodec
 
 logger = logging.getLogger("system")
 
 class InvalidObject(Exception): pass
+class InvalidMetadata(InvalidObject): pass
 class CannotConvertToPython(Exception): pass
 
-_MAX_PAYLOAD_BYTES = 2048
 
+class IdGenerator(object):
+    """
+    Generates object ids from a random per-process node prefix and a
+    counter.  Ids are unique as long as node prefixes are, which makes them
+    far cheaper than email.utils.make_msgid() while staying plain strings.
+    Call reset() in a forked child so that it doesn't share the prefix of
+    its parent.
+    """
+    def __init__(self, node=None):
+        self.node = node
+        self.reset()
+
+    def reset(self):
+        if self.node is None:
+            self.prefix = uuid4().hex[:16] + '.'
+        else:
+            self.prefix = self.node + '.'
+        self.counter = count().next
+
+    def __call__(self):
+        return '%s%x' % (self.prefix, self.counter())
+
+_id_generator = IdGenerator()
+
+def make_id():
+    return _id_generator()
+
+def set_id_generator(generator):
+    """
+    Replaces the generator used for objects created without an id; any
+    callable returning unique strings will do.
+    """
+    global _id_generator
+    _id_generator = generator
+
+
+class Metadata(dict):
+    """
+    Metadata of a BusinessObject.  The version number changes whenever a key
+    is set or removed, which lets encoded metadata be cached and shared by
+    all recipients of an object.  Changes inside nested values (appending to
+    the route list, say) aren't noticed: assign a new value or call touch().
+    """
+    __slots__ = ['version']
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+
+    def touch(self):
+        self.version += 1
 
-def read_until_nul(socket, last_activity_timeout_secs=5, read_timeout_secs=120):
-    started = datetime.now()
-    last_activity = datetime.now()
-    ret = bytearray()
-    while len(ret) <= _MAX_PAYLOAD_BYTES:
-        now = datetime.now()
-        if now - timedelta(seconds=last_activity_timeout_secs) > last_activity or \
-           now - timedelta(seconds=read_timeout_secs) > started:
-            raise InvalidObject("Timed out reading metadata")
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version += 1
 
-        char = socket.recv(1)
-        if len(char) == 0 or char == '\x00':
-            break
-        ret.extend(char)
-        last_activity = now
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version += 1
 
-    return ret
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
 
+    def pop(self, *args):
+        self.version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.version += 1
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version += 1
+
+
+_OBJECT_TYPE_RE = re.compile(ur"(?P<type>\w+)/(?P<subtype>[\w-]+)(;\s+charset=)?(?P<charset>[-\w\d]+)?")
+_OBJECT_TYPE_CACHE_SIZE = 1024
+_object_types = {}
 
 class ObjectType(object):
+    """
+    Parsed content type.  Instances returned by from_string() are shared
+    between objects and mustn't be modified.
+    """
+    __slots__ = ['content_type', 'subtype', 'metadata']
+
     def __init__(self, content_type, subtype, metadata=None):
         self.content_type = content_type
         self.subtype = subtype
@@ -52,12 +125,25 @@ class ObjectType(object):
 
     @classmethod
     def from_string(cls, s):
-        m = re.match(ur"(?P<type>\w+)/(?P<subtype>[\w-]+)(;\s+charset=)?(?P<charset>[-\w\d]+)?", s)
+        """
+        Parses a type string.  Parsed types are interned in a bounded cache
+        keyed by the string, since only a handful of distinct types are in
+        use at any time.
+        """
+        ret = _object_types.get(s, None)
+        if ret is not None:
+            return ret
+
+        m = _OBJECT_TYPE_RE.match(s)
         content_type = m.group('type')
         subtype = m.group('subtype')
         metadata = {'charset': m.group('charset')}
+        ret = ObjectType(content_type, subtype, metadata=metadata)
 
-        return ObjectType(content_type, subtype, metadata=metadata)
+        if len(_object_types) >= _OBJECT_TYPE_CACHE_SIZE:
+            _object_types.clear()
+        _object_types[s] = ret
+        return ret
 
     def __unicode__(self):
         ret = u'{0}/{1}'.format(self.content_type, self.subtype)
@@ -69,13 +155,23 @@ class ObjectType(object):
         return unicode(self).encode('ASCII', 'backslashreplace')
 
 
+_UNPARSED = object()
+
 class BusinessObject(object):
+    """
+    An object of the object system: a metadata dictionary and an optional
+    payload of metadata['size'] bytes.  The content type is parsed from
+    metadata['type'] only when content_type is first accessed, as most
+    routed objects are never looked at that closely.
+    """
+    __slots__ = ['_metadata', '_content_type', 'encoded', 'id', 'payload', 'size', 'event']
+
     def __init__(self, metadata_dict, payload):
         self.metadata = metadata_dict
         if 'id' in metadata_dict:
             self.id = metadata_dict['id']
         else:
-            self.id = make_msgid()
+            self.id = _id_generator()
 
         self.payload = payload
 
@@ -84,13 +180,51 @@ class BusinessObject(object):
         else:
             self.size = 0
 
-        if 'type' in metadata_dict:
-            self.content_type = ObjectType.from_string(metadata_dict['type'])
-        else:
-            self.content_type = None
-
+        self._content_type = _UNPARSED
         self.event = metadata_dict.get('event', None)
 
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata_dict):
+        if not isinstance(metadata_dict, Metadata):
+            metadata_dict = Metadata(metadata_dict)
+        self._metadata = metadata_dict
+        # A new Metadata starts over at version 0, which would match what
+        # was cached for the old one.
+        self.encoded = None
+
+    @property
+    def content_type(self):
+        if self._content_type is _UNPARSED:
+            if 'type' in self._metadata:
+                self._content_type = ObjectType.from_string(self._metadata['type'])
+            else:
+                self._content_type = None
+        return self._content_type
+
+    @content_type.setter
+    def content_type(self, content_type):
+        self._content_type = content_type
+
+    def sync_metadata(self):
+        """
+        Writes the id, size and type attributes to the metadata, touching
+        only the keys whose values differ.  A type that has never been
+        parsed is already in the metadata as it is.
+        """
+        metadata = self._metadata
+        if metadata.get('id', None) != self.id:
+            metadata['id'] = self.id
+        if metadata.get('size', None) != self.size:
+            metadata['size'] = self.size
+        if self._content_type is not _UNPARSED and self._content_type is not None:
+            content_type = str(self._content_type)
+            if metadata.get('type', None) != content_type:
+                metadata['type'] = content_type
+
     def of_content_type(self, content_type):
         if self.content_type and \
                self.content_type.content_type == content_type:
@@ -116,8 +250,15 @@ class BusinessObject(object):
         if charset is None:
             charset = 'utf-8'
 
+        # Only a prefix long enough for the snippet is decoded, the payload
+        # may be large (and spooled to disk).
+        limit = max_length * 4
         try:
-            ret = self.payload.decode(charset).encode('ASCII', 'backslashreplace')
+            if len(self.payload) > limit:
+                text = bytearray(self.payload[:limit]).decode(charset, 'ignore')
+            else:
+                text = self.payload.decode(charset)
+            ret = text.encode('ASCII', 'backslashreplace')
         except Exception, e:
             logger.error(u"{0} while decoding payload with charset {1}".format(e, charset))
             return u''
@@ -135,35 +276,24 @@ class BusinessObject(object):
     def __eq__(self, other):
         return self.__hash__() == other.__hash__()
 
-    def _to_file(self, serialized, file):
+    def _to_file(self, buffers, file):
         with io.FileIO(file.fileno(), 'w', closefd=False) as f:
-            writer = io.BufferedWriter(f, buffer_size=len(serialized))
-            writer.write(serialized)
+            writer = io.BufferedWriter(f)
+            for buffer in buffers:
+                writer.write(buffer)
             writer.flush()
             file.flush()
 
-    def _to_socket(self, serialized, socket):
-        sent_total = 0
-        while sent_total < len(serialized):
-            sent = socket.send(serialized[sent_total:])
-            if sent == 0:
-                raise RuntimeError("socket connection broken")
-            sent_total += sent
-        return len(serialized), sent_total
-
-    def serialize(self, file=None, socket=None):
+    def serialize(self, file=None, socket=None, encoder=None):
         """
-        Serializes the object to bytearray, file or socket.
+        Serializes the object to bytearray, file or socket.  When writing to
+        a file or a socket, the metadata and the payload are written as
+        separate buffers and the payload isn't copied.  The metadata is
+        JSON unless another protocol.Encoder is given.
         """
-        self.metadata['id'] = self.id
-        self.metadata['size'] = self.size
-        if self.content_type is not None:
-            self.metadata['type'] = str(self.content_type)
-
-        ret = bytearray(json.dumps(self.metadata, ensure_ascii=False), encoding='utf-8')
-        ret += '\x00'
-        if self.size > 0:
-            ret.extend(self.payload)
+        from protocol import default_encoder, send_buffers
+        if encoder is None:
+            encoder = default_encoder
 
         # If the caller forgets to use named parameter, the first parameter
         # gets bound to file and if it's a socket, we can fix the situation
@@ -173,36 +303,38 @@ class BusinessObject(object):
             file = None
 
         if file is not None:
-            return self._to_file(ret, file)
+            return self._to_file(encoder.buffers(self), file)
         elif socket is not None:
-            return self._to_socket(ret, socket)
+            buffers = encoder.buffers(self)
+            size = sum(len(buffer) for buffer in buffers)
+            return size, send_buffers(socket, buffers)
         else:
-            return ret
+            return encoder.encode(self)
 
     def payload_as_python(self):
         if self.content_type and \
             (self.content_type.subtype == 'json' or
              self.content_type.subtype == 'javascript'):
-            payload_string = self.payload.decode('utf-8')
-            return json.loads(payload_string)
+            return jsoncodec.loads(self.payload)
         else:
             raise CannotConvertToPython("Type %s can't be transformed to Python." %
                                           str(self.content_type))
 
     @classmethod
     def from_string(self, string):
+        payload = bytearray(string, encoding='utf-8')
         metadata_dict = {
-            'size': len(string),
+            'size': len(payload),
             'type': "text/plain; charset=UTF-8"
             }
-        return BusinessObject(metadata_dict, bytearray(string, encoding='utf-8'))
+        return BusinessObject(metadata_dict, payload)
 
     @classmethod
     def from_python(self, metadata, obj):
-        payload = json.dumps(obj)
+        payload = bytearray(jsoncodec.dumpb(obj))
         metadata['size'] = len(payload)
         metadata['type'] = "application/json"
-        return BusinessObject(metadata, bytearray(string, encoding='utf-8'))
+        return BusinessObject(metadata, payload)
 
     @classmethod
     def from_file(self, path):
@@ -222,37 +354,15 @@ class BusinessObject(object):
 
     @classmethod
     def read_from_socket(cls, socket, last_activity_timeout_secs=5, read_timeout_secs=120):
-        started = datetime.now()
-        last_activity = datetime.now()
-        metadata = read_until_nul(socket, last_activity_timeout_secs, read_timeout_secs)
+        """
+        Reads one object from a socket or a protocol.SocketReader.  Returns
+        None if the connection was closed or the metadata was invalid.
+        """
+        from protocol import reader_for
+
         try:
-            metadata = metadata.decode('utf-8')
-            metadata_dict = json.loads(metadata)
-
-            if 'size' in metadata_dict and metadata_dict['size'] > 0:
-                # logger.debug("Reading payload of size %i" % metadata_dict['size'])
-                payload = bytearray()
-                while len(payload) < metadata_dict['size']:
-                    now = datetime.now()
-                    if now - timedelta(seconds=last_activity_timeout_secs) > last_activity or \
-                       now - timedelta(seconds=read_timeout_secs) > started:
-                        raise InvalidObject("Timed out while reading payload from %s" %
-                                            str(socket))
-
-                    received = socket.recv(metadata_dict['size'] - len(payload))
-                    if len(received) > 0:
-                        last_activity = now
-                    payload.extend(received)
-
-                assert(len(payload) == metadata_dict['size'])
-            else:
-                # logger.debug("Not reading payload")
-                payload = None
-
-            return BusinessObject(metadata_dict, payload)
-        except ValueError, ve:
-            if len(metadata) > 100:
-                metadata = metadata[0:75] + "..."
-            logger.warning("Couldn't load JSON from '%s'" % metadata)
+            return reader_for(socket).read_object(last_activity_timeout_secs,
+                                                  read_timeout_secs)
+        except InvalidMetadata, im:
+            logger.warning(u"{0}".format(im))
             return None
-
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import fcntl
 import logging
+import os
 import signal
+import subprocess
+import sys
 
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from unittest import main as unittest_main
 from optparse import OptionParser
 from datetime import datetime, timedelta
@@ -11,6 +15,7 @@ from datetime import datetime, timedelta
 import socket
 import json
 from uuid import uuid4
+from tempfile import mkdtemp
 
 import gevent
 
@@ -18,18 +23,28 @@ from gevent import Greenlet
 from gevent import socket
 from gevent import sleep
 from gevent import select
-
-from system import BusinessObject, InvalidObject
-from server import ObjectoPlex
+from gevent.queue import Queue
+from gevent.server import StreamServer
+
+from system import BusinessObject, InvalidObject, InvalidMetadata
+from protocol import Decoder, Encoder, MsgpackEncoder, CompressingEncoder, SocketReader, PartialPayload
+from protocol import msgpack, negotiate_encoder
+from jsoncodec import available_codecs
+from server import ObjectoPlex, Sender, SeenIds
+from backpressure import SendQueue
+from workers import SharedStatistics, merge_statistics
+from scheduler import Scheduler
+from rule_engine import routing_decision, compile_rules, match, LRUCache, SubscriptionIndex
+from handoff import LISTEN_FD_ENV, inherited_listener, restart
 from middleware import *
 from services.client_registry import ClientRegistry
-from utils import reply_for_object, read_object_with_timeout
+from utils import reply_for_object, read_object_with_timeout, connect, subscription_object
 
 logger = logging.getLogger("tests")
 
 
 class BaseTestCase(TestCase):
-    def start_server(self, host, port, linked_servers=[]):
+    def start_server(self, host, port, linked_servers=[], **kwargs):
         result = ObjectoPlex((host, port),
                              middlewares=[
                                  PingPongMiddleware(),
@@ -38,7 +53,8 @@ class BaseTestCase(TestCase):
                                  ChecksumMiddleware(),
                                  RoutingMiddleware(),
                                  ],
-                             linked_servers=linked_servers)
+                             linked_servers=linked_servers,
+                             **kwargs)
         gevent.signal(signal.SIGTERM, result.stop)
         gevent.signal(signal.SIGINT, result.stop)
         Greenlet.spawn(result.serve_forever)
@@ -105,6 +121,572 @@ class TwoServerTestCase(BaseTestCase):
         super(TwoServerTestCase, self).tearDown()
 
 
+class JsonCodecTestCase(TestCase):
+    def test_codecs_agree(self):
+        metadata = {u'event': u'routing/subscribe', u'name': u'h\u00e4m\u00e4h\u00e4kki',
+                    u'subscriptions': [u'text/*'], u'size': 0, u'echo': False,
+                    u'big': [123456789012345678901234567890, -2**70]}
+        for codec in available_codecs():
+            data = codec.dumpb(metadata)
+            self.assertIsInstance(data, str)
+            self.assertEquals(codec.loads(bytearray(data)), metadata)
+            self.assertEquals(codec.loads(codec.dumps(metadata)), metadata)
+            self.assertRaises(ValueError, codec.loads, '{"broken"')
+
+    def test_codecs_reject_non_finite_numbers(self):
+        for codec in available_codecs():
+            self.assertRaises(ValueError, codec.loads, '{"a": 1e400}')
+            self.assertRaises(ValueError, codec.loads, bytearray('{"a": [1, -1E+400]}'))
+            self.assertRaises(ValueError, codec.loads, '{"a": NaN}')
+            self.assertRaises(ValueError, codec.dumpb, {u'a': float('inf')})
+            self.assertEquals(codec.loads('{"a": 1.5e3, "id": "3e400"}'),
+                              {u'a': 1500.0, u'id': u'3e400'})
+        self.assertRaises(InvalidMetadata, Decoder().feed, bytearray('{"a": 1e400}\x00'))
+
+
+class DecoderTestCase(TestCase):
+    def make_objects(self):
+        return [BusinessObject({'event': 'ping'}, None),
+                BusinessObject.from_string(u"p\u00e4yload \x00 with nul"),
+                BusinessObject({'event': 'routing/subscribe', 'subscriptions': ['*']}, None)]
+
+    def test_decodes_pipelined_objects(self):
+        objects = self.make_objects()
+        encoder = Encoder()
+        data = bytearray().join(encoder.encode(obj) for obj in objects)
+
+        decoded = Decoder().feed(data)
+        self.assertEquals([obj.id for obj in decoded], [obj.id for obj in objects])
+        self.assertEquals(decoded[1].payload, objects[1].payload)
+
+    def test_decodes_byte_at_a_time(self):
+        objects = self.make_objects()
+        data = bytearray().join(obj.serialize() for obj in objects)
+
+        decoder = Decoder()
+        decoded = []
+        for index in xrange(len(data)):
+            decoded.extend(decoder.feed(data[index:index + 1]))
+        self.assertEquals([obj.id for obj in decoded], [obj.id for obj in objects])
+        self.assertFalse(decoder.partial())
+
+    def test_encoded_metadata_is_cached_until_changed(self):
+        obj = BusinessObject({'event': 'ping'}, None)
+        encoder = Encoder()
+        header = encoder.encode_metadata(obj)
+        self.assertIs(encoder.encode_metadata(obj), header)
+
+        obj.metadata['route'] = ['somewhere']
+        changed = encoder.encode_metadata(obj)
+        self.assertIsNot(changed, header)
+        self.assertEquals(Decoder().feed(changed)[0].metadata['route'], ['somewhere'])
+
+    def test_encoded_metadata_is_dropped_when_replaced(self):
+        obj = BusinessObject({'event': 'ping', 'id': 'replaced'}, None)
+        encoder = Encoder()
+        encoder.encode_metadata(obj)
+
+        obj.metadata = {'event': 'pong', 'id': 'replaced'}
+        decoded = Decoder().feed(encoder.encode_metadata(obj))
+        self.assertEquals(decoded[0].event, 'pong')
+
+    @skipIf(msgpack is None, "msgpack isn't available")
+    def test_decodes_mixed_metadata_encodings(self):
+        objects = self.make_objects()
+        encoders = [MsgpackEncoder(), Encoder(), MsgpackEncoder()]
+        data = bytearray().join(encoder.encode(obj) for encoder, obj in zip(encoders, objects))
+
+        decoder = Decoder()
+        decoded = []
+        for index in xrange(len(data)):
+            decoded.extend(decoder.feed(data[index:index + 1]))
+        self.assertEquals([obj.metadata for obj in decoded], [obj.metadata for obj in objects])
+        self.assertEquals(decoded[1].payload, objects[1].payload)
+
+    def test_negotiates_known_encodings_only(self):
+        self.assertEquals(negotiate_encoder(None).name, 'json')
+        self.assertEquals(negotiate_encoder(['bson', 'json']).name, 'json')
+        if msgpack is not None:
+            self.assertEquals(negotiate_encoder('msgpack').name, 'msgpack')
+
+    def test_compresses_text_payloads_once(self):
+        text = BusinessObject.from_string(u"compressible text " * 200)
+        binary = BusinessObject({'type': 'application/octet-stream', 'size': 4096},
+                                bytearray(4096))
+        encoder = CompressingEncoder()
+        self.assertIsNotNone(encoder.compressed_payload(text))
+        self.assertIsNone(encoder.compressed_payload(binary))
+
+        data = encoder.encode(text)
+        self.assertLess(len(data), text.size)
+        self.assertIs(CompressingEncoder(Encoder()).compressed_payload(text),
+                      encoder.compressed_payload(text))
+
+        decoded = Decoder().feed(data + encoder.encode(binary))
+        self.assertEquals(decoded[0].payload, text.payload)
+        self.assertEquals(decoded[0].size, text.size)
+        self.assertNotIn('payload-compression', decoded[0].metadata)
+        self.assertEquals(decoded[1].payload, binary.payload)
+
+    def test_compresses_configured_types(self):
+        text = BusinessObject.from_string(u"compressible text " * 200)
+        binary = BusinessObject({'type': 'application/octet-stream', 'size': 4096},
+                                bytearray(4096))
+        encoder = negotiate_encoder(None, 'deflate', 1024, ['application/*'])
+        self.assertIsNone(encoder.compressed_payload(text))
+        self.assertIsNotNone(encoder.compressed_payload(binary))
+        self.assertIs(negotiate_encoder(None, 'deflate', 1024, ('application/*',)), encoder)
+        self.assertIsNotNone(negotiate_encoder(None, 'deflate', 1024).compressed_payload(text))
+
+    def test_limits_inflated_payloads(self):
+        bomb = BusinessObject.from_string(u"0" * 65536)
+        data = CompressingEncoder().encode(bomb)
+
+        self.assertEquals(Decoder(max_inflated_bytes=65536).feed(data)[0].size, 65536)
+        self.assertRaises(InvalidObject, Decoder(max_inflated_bytes=4096).feed, data)
+        self.assertRaises(InvalidObject, Decoder(max_inflated_bytes=None).feed, data)
+
+    def test_rejects_truncated_compressed_payloads(self):
+        text = BusinessObject.from_string(u"compressible text " * 200)
+        data = CompressingEncoder().encode(text)
+        decoded = Decoder().feed(data)[0]
+        self.assertEquals(decoded.payload, text.payload)
+
+        compressed = CompressingEncoder().compressed_payload(text)
+        for payload in [compressed[:20], compressed[:-2], compressed + 'junk']:
+            truncated = BusinessObject({'type': 'text/plain', 'size': len(payload),
+                                        'payload-compression': 'deflate'}, bytearray(payload))
+            self.assertRaises(InvalidObject, Decoder().feed, Encoder().encode(truncated))
+
+    def make_large_object(self):
+        payload = bytearray(xrange(256)) * 64
+        return BusinessObject({'type': 'application/octet-stream',
+                               'size': len(payload)}, payload)
+
+    def test_spools_large_payloads(self):
+        obj = self.make_large_object()
+        data = obj.serialize()
+
+        decoder = Decoder(spool_threshold=1024)
+        decoded = decoder.feed(data[:100]) + decoder.feed(data[100:])
+        self.assertEquals(len(decoded), 1)
+        self.assertNotIsInstance(decoded[0].payload, bytearray)
+        self.assertEquals(decoded[0].payload[:], bytes(obj.payload))
+
+    def test_cut_through_returns_object_before_payload(self):
+        obj = self.make_large_object()
+        data = obj.serialize()
+
+        decoder = Decoder(cut_through_threshold=1024)
+        decoded = decoder.feed(data[:5000])
+        self.assertEquals(len(decoded), 1)
+        started = decoded[0]
+        self.assertIsInstance(started.payload, PartialPayload)
+        self.assertFalse(started.payload.complete())
+
+        self.assertEquals(decoder.feed(data[5000:]), [])
+        self.assertEquals(started.payload[:], bytes(obj.payload))
+
+    def test_invalid_metadata(self):
+        decoder = Decoder()
+        self.assertRaises(InvalidMetadata, decoder.feed, bytearray('{"size": \x00'))
+        self.assertRaises(InvalidMetadata, decoder.feed, bytearray('x' * 4096))
+
+
+class RecordingSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytearray(data))
+        return len(data)
+
+
+class SenderTestCase(TestCase):
+    def setUp(self):
+        class Client(object):
+            closed = None
+            def close(self, message=""):
+                self.closed = message
+        self.client = Client()
+        self.client.address = ('localhost', 0)
+        self.client.socket = RecordingSocket()
+        self.client.encoder = Encoder()
+        self.client.queue = Queue(maxsize=100)
+        self.sender = Sender(self.client)
+
+    def test_sends_queued_objects_in_one_write(self):
+        objects = [BusinessObject({'event': 'ping', 'n': i}, None) for i in xrange(50)]
+        for obj in objects[1:]:
+            self.client.queue.put(obj)
+
+        self.assertIsNone(self.sender._send_batch(objects[0]))
+        self.assertEquals(len(self.client.socket.sent), 1)
+        decoded = Decoder().feed(self.client.socket.sent[0])
+        self.assertEquals([obj.id for obj in decoded], [obj.id for obj in objects])
+
+    def test_stops_batch_at_partial_payload(self):
+        partial = BusinessObject({'size': 10}, PartialPayload(10))
+        last = BusinessObject({'event': 'ping'}, None)
+        self.client.queue.put(partial)
+        self.client.queue.put(last)
+
+        self.assertIs(self.sender._send_batch(BusinessObject({'event': 'ping'}, None)), partial)
+        self.assertIs(self.client.queue.get_nowait(), last)
+
+    def test_closes_client_on_unencodable_object(self):
+        self.client.queue.put(BusinessObject({'event': 'ping', 'tags': set(['x'])}, None))
+        self.sender.start()
+        self.sender.join(timeout=1.0)
+        self.assertTrue(self.sender.ready())
+        self.assertIsNotNone(self.client.closed)
+
+
+class SendQueueTestCase(TestCase):
+    def make_objects(self, count, size=0):
+        return [BusinessObject({'n': i, 'size': size}, bytearray(size) if size else None)
+                for i in xrange(count)]
+
+    def drain(self, queue):
+        ret = []
+        while not queue.empty():
+            ret.append(queue.get_nowait().metadata['n'])
+        return ret
+
+    def test_drop_oldest(self):
+        queue = SendQueue('drop-oldest', max_objects=3)
+        for obj in self.make_objects(5):
+            queue.put(obj)
+        self.assertEquals(self.drain(queue), [2, 3, 4])
+        self.assertEquals(queue.dropped, 2)
+
+    def test_drop_newest_by_bytes(self):
+        queue = SendQueue('drop-newest', max_objects=None, max_bytes=250)
+        for obj in self.make_objects(5, size=100):
+            queue.put(obj)
+        self.assertEquals(self.drain(queue), [0, 1])
+        self.assertEquals(queue.dropped_bytes, 300)
+
+    def test_disconnects_slow_consumer_after_grace(self):
+        disconnected = []
+        queue = SendQueue('disconnect', max_objects=1, grace_secs=0.05,
+                          on_slow_consumer=lambda: disconnected.append(True))
+        for obj in self.make_objects(3):
+            queue.put(obj)
+        self.assertEquals(disconnected, [])
+        sleep(0.1)
+        for obj in self.make_objects(3):
+            queue.put(obj)
+        self.assertEquals(disconnected, [True])
+
+    def test_spills_to_disk_in_order(self):
+        queue = SendQueue('spill', max_objects=2)
+        objects = self.make_objects(10, size=10)
+        for obj in objects[:6]:
+            queue.put(obj)
+        self.assertEquals(queue.qsize(), 6)
+        self.assertEquals([queue.get_nowait().metadata['n'] for i in xrange(3)], [0, 1, 2])
+        for obj in objects[6:]:
+            queue.put(obj)
+        self.assertEquals(self.drain(queue), range(3, 10))
+        self.assertEquals(queue.dropped, 0)
+
+        queue.put(objects[0])
+        self.assertEquals(queue.spilled, 0)
+
+    def test_block_waits_for_room(self):
+        queue = SendQueue('block', max_objects=2)
+        objects = self.make_objects(3)
+        putter = Greenlet.spawn(lambda: [queue.put(obj) for obj in objects])
+        sleep(0.01)
+        self.assertFalse(putter.ready())
+        self.assertEquals(queue.get().metadata['n'], 0)
+        putter.join(timeout=1.0)
+        self.assertTrue(putter.ready())
+        self.assertEquals(self.drain(queue), [1, 2])
+
+
+class WorkerStatisticsTestCase(TestCase):
+    def test_merges_statistics_of_workers(self):
+        shared = SharedStatistics(3, slot_bytes=4096)
+        shared.publish(1, {'client count': 2, 'events by type': {'ping': 1},
+                           'average send queue length': 4.0})
+        shared.publish(2, {'client count': 3, 'events by type': {'ping': 2, 'pong': 1},
+                           'average send queue length': 0.0})
+        self.assertEquals(len(shared.collect(exclude=1)), 1)
+
+        own = {'client count': 1, 'events by type': {}, 'average send queue length': 2.0}
+        merged = merge_statistics([own] + shared.collect(exclude=0),
+                                  averaged=['average send queue length'])
+        self.assertEquals(merged['client count'], 6)
+        self.assertEquals(merged['events by type'], {'ping': 3, 'pong': 1})
+        self.assertEquals(merged['average send queue length'], 2.0)
+
+
+class RulesTestCase(TestCase):
+    def decide(self, rules, metadata):
+        return routing_decision(BusinessObject(metadata, None), rules)
+
+    def test_matches_like_match(self):
+        for rule, matchable in [('text/*', 'text'), ('text', 'text/plain'), ('text/plain', 'text'),
+                                ('*', 'image/png'), ('text/*/x', 'text/plain'), ('', 'text'),
+                                ('text/plain', 'text/plain; charset=UTF-8')]:
+            self.assertEquals(self.decide([rule], {'type': matchable}), match(rule, matchable),
+                              msg=u"{0} {1}".format(rule, matchable))
+            self.assertEquals(self.decide(['@' + rule], {'event': matchable}),
+                              match(rule, matchable))
+
+    def test_last_matching_rule_decides(self):
+        self.assertTrue(self.decide(['*'], {}))
+        self.assertFalse(self.decide(['text/*'], {}))
+        self.assertFalse(self.decide(['*', '!text/*'], {'type': 'text/plain'}))
+        self.assertTrue(self.decide(['!text/*', '*'], {'type': 'text/plain'}))
+        self.assertTrue(self.decide(['#news'], {'natures': ['sports', 'news/local']}))
+        self.assertFalse(self.decide(['@*', '!@ping'], {'event': 'ping'}))
+
+    def test_equal_rule_lists_share_compiled_rules(self):
+        self.assertIs(compile_rules(['text/*', '@ping']), compile_rules(['text/*', '@ping']))
+        self.assertIsNot(compile_rules(['text/*']), compile_rules(['image/*']))
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(len(cache), 2)
+
+
+class SubscriptionIndexTestCase(TestCase):
+    rule_lists = [['*'], ['text/*'], ['text/plain'], ['*', '!text/*', 'text/plain'],
+                  ['@*'], ['@routing/*', '!@routing/announcement'], ['#news', 'image'],
+                  ['!*'], ['#*', '!#news/sports'], ['text/plain/*', '@ping'], ['text'], []]
+    objects = [BusinessObject({'type': 'text/plain'}, 'x'),
+               BusinessObject({'type': 'text/html'}, 'x'),
+               BusinessObject({'type': 'image/png'}, 'x'),
+               BusinessObject({'event': 'ping'}, None),
+               BusinessObject({'event': 'routing/announcement/neighbors'}, None),
+               BusinessObject({'event': 'routing/subscribe'}, None),
+               BusinessObject({'type': 'text/plain', 'natures': ['news/sports']}, 'x'),
+               BusinessObject({'natures': ['news']}, None),
+               BusinessObject({}, None)]
+
+    def test_agrees_with_routing_decision(self):
+        index = SubscriptionIndex()
+        for position, rules in enumerate(self.rule_lists):
+            index.update(position, rules)
+
+        for obj in self.objects:
+            expected = [position for position, rules in enumerate(self.rule_lists)
+                        if routing_decision(obj, rules)]
+            self.assertEquals(sorted(index.recipients(obj)), expected,
+                              msg=u"{0}".format(obj.metadata))
+
+    def test_updates_and_removes(self):
+        index = SubscriptionIndex()
+        obj = BusinessObject({'type': 'text/plain'}, 'x')
+        index.update('client', ['text/*'])
+        self.assertEquals(index.recipients(obj), ('client', ))
+        index.update('client', ['image/*'])
+        self.assertEquals(index.recipients(obj), ())
+        index.remove('client')
+        self.assertEquals(index.buckets, {})
+
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self.ping = PingPongMiddleware()
+        self.legacy = LegacySubscriptionMiddleware()
+        self.statistics = StatisticsMiddleware()
+        self.checksum = ChecksumMiddleware()
+        self.routing = RoutingMiddleware()
+        self.pipeline = Pipeline([self.ping, self.legacy, self.statistics, self.checksum,
+                                  self.routing])
+
+    def test_data_path_skips_event_middlewares(self):
+        obj = BusinessObject({'type': 'text/plain'}, 'hello')
+        self.assertEquals(self.pipeline.handlers(obj),
+                          (self.statistics, self.checksum, self.routing))
+
+    def test_event_gets_its_middlewares_in_order(self):
+        self.assertEquals(self.pipeline.handlers(BusinessObject({'event': 'ping'}, None)),
+                          (self.ping, self.statistics, self.checksum, self.routing))
+        self.assertEquals(self.pipeline.handlers(BusinessObject({'event': 'clients/register'},
+                                                                None)),
+                          (self.legacy, self.statistics, self.checksum, self.routing))
+
+    def test_skips_inherited_hooks(self):
+        self.assertEquals(self.pipeline.connect, (self.statistics, self.routing))
+        self.assertEquals(self.pipeline.disconnect, (self.statistics, self.routing))
+
+
+class RoutingDirectoryTestCase(TestCase):
+    def test_finds_clients_by_routing_ids(self):
+        class Client(object):
+            routing_id = 'a'
+            extra_routing_ids = ['b']
+
+        directory = RoutingDirectory()
+        client = Client()
+        directory.update(client)
+        self.assertEquals(directory.lookup('b'), (set([client]), []))
+        self.assertEquals(directory.lookup(['a', 'c']), (set([client]), ['c']))
+
+        client.extra_routing_ids = []
+        directory.update(client)
+        self.assertEquals(directory.lookup('b'), (set(), ['b']))
+        directory.remove(client)
+        self.assertEquals(directory.clients, {})
+
+
+class RoutingTableTestCase(TestCase):
+    def test_learns_from_route_and_announcements(self):
+        table = RoutingTable()
+        table.learn(BusinessObject({'route': ['client', 'server2']}, None), 'server2')
+        table.learn(BusinessObject({'event': 'routing/announcement/neighbors',
+                                    'route': ['server3'], 'node': 'server3',
+                                    'neighbors': [{'routing-id': 'other'}]}, None), 'server3')
+        self.assertEquals(table.next_hop('client'), 'server2')
+        self.assertEquals(table.next_hop('other'), 'server3')
+        self.assertIsNone(table.next_hop('unknown'))
+
+        table.learn(BusinessObject({'event': 'routing/disconnect', 'routing-id': 'other',
+                                    'route': ['server3']}, None), 'server3')
+        self.assertIsNone(table.next_hop('other'))
+        table.forget_link('server2')
+        self.assertIsNone(table.next_hop('client'))
+
+    def test_keeps_shorter_paths(self):
+        table = RoutingTable()
+        # A copy forwarded by server2 arrives before the one sent directly.
+        table.learn(BusinessObject({'route': ['client', 'server3', 'server2']}, None), 'server2')
+        self.assertEquals(table.next_hop('client'), 'server2')
+        self.assertIsNone(table.next_hop('server3'))
+
+        table.learn(BusinessObject({'route': ['client', 'server3']}, None), 'server3')
+        table.learn(BusinessObject({'route': ['client', 'server3', 'server2']}, None), 'server2')
+        self.assertEquals(table.next_hop('client'), 'server3')
+
+    def test_routes_expire(self):
+        table = RoutingTable(ttl_secs=0.01)
+        table.learn(BusinessObject({'route': ['client']}, None), 'server2')
+        sleep(0.02)
+        self.assertIsNone(table.next_hop('client'))
+        table.prune()
+        self.assertEquals(table.next_hops, {})
+
+
+class SeenIdsTestCase(TestCase):
+    def test_remembers_ids(self):
+        seen = SeenIds()
+        self.assertFalse(seen.seen('a'))
+        self.assertTrue(seen.seen('a'))
+        self.assertFalse(seen.seen('b'))
+        self.assertEquals((seen.hits, seen.misses), (1, 2))
+
+    def test_is_bounded(self):
+        seen = SeenIds(max_ids=4)
+        for id in 'abcde':
+            seen.seen(id)
+        self.assertFalse(seen.seen('a'))
+        self.assertTrue(seen.seen('e'))
+        self.assertLessEqual(len(seen.current) + len(seen.previous), 4)
+
+    def test_forgets_after_window(self):
+        seen = SeenIds(window_secs=0.01)
+        seen.seen('a')
+        sleep(0.02)
+        seen.seen('b')
+        sleep(0.02)
+        seen.seen('c')
+        self.assertFalse(seen.seen('a'))
+
+
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.calls = []
+
+    def tearDown(self):
+        self.scheduler.kill()
+
+    def test_calls_in_order_of_deadline(self):
+        self.scheduler.call_later(0.06, self.calls.append, 'late')
+        self.scheduler.call_later(0.02, self.calls.append, 'early')
+        sleep(0.1)
+        self.assertEquals(self.calls, ['early', 'late'])
+
+    def test_cancelled_timer_is_not_called(self):
+        timer = self.scheduler.call_later(0.02, self.calls.append, 'cancelled')
+        self.scheduler.call_later(0.03, self.calls.append, 'kept')
+        timer.cancel()
+        sleep(0.06)
+        self.assertEquals(self.calls, ['kept'])
+
+    def test_repeats_until_cancelled(self):
+        timer = self.scheduler.call_every(0.02, self.calls.append, 'tick')
+        sleep(0.11)
+        timer.cancel()
+        count = len(self.calls)
+        self.assertGreaterEqual(count, 3)
+        sleep(0.05)
+        self.assertEquals(len(self.calls), count)
+
+    def test_failing_callback_doesnt_stop_scheduler(self):
+        self.scheduler.call_later(0.01, lambda: 1 / 0)
+        self.scheduler.call_later(0.02, self.calls.append, 'after')
+        sleep(0.05)
+        self.assertEquals(self.calls, ['after'])
+
+
+class SocketReaderTestCase(TestCase):
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+
+    def tearDown(self):
+        self.sock.close()
+        self.other.close()
+
+    def test_reads_pipelined_objects(self):
+        first = BusinessObject.from_string(u"first")
+        second = BusinessObject({'event': 'ping'}, None)
+        self.other.sendall(first.serialize() + second.serialize())
+
+        reader = SocketReader(self.sock)
+        obj = BusinessObject.read_from_socket(reader)
+        self.assertEquals(obj.id, first.id)
+        self.assertEquals(obj.payload, bytearray(u"first", encoding='utf-8'))
+        self.assertTrue(reader.pending())
+
+        obj = BusinessObject.read_from_socket(reader)
+        self.assertEquals(obj.id, second.id)
+        self.assertFalse(reader.pending())
+
+    def test_reads_payload_split_across_sends(self):
+        obj = BusinessObject.from_string(u"x" * 100000)
+        serialized = obj.serialize()
+        reader = SocketReader(self.sock, chunk_size=16)
+        self.other.sendall(serialized[:50])
+        Greenlet.spawn(self.other.sendall, serialized[50:])
+
+        received = BusinessObject.read_from_socket(reader)
+        self.assertEquals(received.payload, obj.payload)
+
+    def test_serializes_large_payload_to_socket(self):
+        payload = bytearray(xrange(256)) * 8192
+        obj = BusinessObject({'type': 'application/octet-stream',
+                              'size': len(payload)}, payload)
+        sender = Greenlet.spawn(obj.serialize, socket=self.other)
+
+        received = BusinessObject.read_from_socket(self.sock)
+        self.assertEquals(received.payload, payload)
+        size, sent = sender.get()
+        self.assertEquals(size, sent)
+
+
 class ConnectionTest(SingleServerTestCase):
     def test_server_accepts_connection(self):
         global _host, _port
@@ -113,6 +695,121 @@ class ConnectionTest(SingleServerTestCase):
         sock.close()
         logger.info("Closed socket")
 
+class SnapshotTestCase(SingleServerTestCase):
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((_host, _port))
+        sleep(0.05)
+        return sock
+
+    def test_snapshot_changes_only_with_clients(self):
+        sock = self.connect()
+        snapshot, version = self.server.snapshot, self.server.snapshot_version
+        self.assertEquals(len(snapshot), 1)
+
+        BusinessObject({'event': 'ping'}, None).serialize(socket=sock)
+        sleep(0.05)
+        self.assertIs(self.server.snapshot, snapshot)
+
+        other = self.connect()
+        self.assertEquals(len(self.server.snapshot), 2)
+        self.assertGreater(self.server.snapshot_version, version)
+        self.assertEquals(len(snapshot), 1)
+        other.close()
+        sock.close()
+
+
+class UnixSocketTestCase(BaseTestCase):
+    def setUp(self):
+        self.path = os.path.join(mkdtemp(), 'objectoplex.sock')
+        self.server = self.start_server(_host, _port, unix_socket=self.path)
+
+    def tearDown(self):
+        self.server.stop(timeout=0)
+        os.rmdir(os.path.dirname(self.path))
+
+    def test_subscribes_over_unix_socket(self):
+        sock = connect(path=self.path, socket=socket)
+        subscription = subscription_object(['*'])
+        subscription.serialize(socket=sock)
+        reply, time = reply_for_object(subscription, sock, select=select)
+        self.assertIsNotNone(reply)
+        self.assertEquals(reply.event, 'routing/subscribe/reply')
+        sock.close()
+
+        self.server.stop(timeout=0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+_SUCCESSOR = """
+from objectoplex.handoff import LISTEN_FD_ENV, inherited_listener, notify_ready
+listener = inherited_listener(LISTEN_FD_ENV)
+notify_ready()
+listener.setblocking(1)
+connection, address = listener.accept()
+listener.close()
+connection.sendall('successor')
+connection.close()
+"""
+
+_STUCK_SUCCESSOR = """
+import signal, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+time.sleep(60)
+"""
+
+class HandoffTestCase(SingleServerTestCase):
+    def test_inherits_listener(self):
+        os.environ[LISTEN_FD_ENV] = str(os.dup(self.server.socket.fileno()))
+        listener = inherited_listener(LISTEN_FD_ENV)
+        self.assertNotIn(LISTEN_FD_ENV, os.environ)
+        self.assertEquals(listener.getsockname(), self.server.socket.getsockname())
+        listener.close()
+
+    def test_successor_takes_over_listener(self):
+        self.assertTrue(restart(self.server, argv=[sys.executable, '-c', _SUCCESSOR],
+                                ready_timeout_secs=10.0, drain_timeout_secs=1.0))
+        self.assertTrue(self.server.closed)
+
+        sock = socket.create_connection((_host, _port))
+        self.assertEquals(sock.recv(100), 'successor')
+        sock.close()
+
+    def test_keeps_serving_if_successor_fails(self):
+        self.assertFalse(restart(self.server, argv=[sys.executable, '-c', 'pass'],
+                                 ready_timeout_secs=10.0))
+        sock = connect(_host, _port, socket=socket)
+        subscription = subscription_object(['*'])
+        subscription.serialize(socket=sock)
+        reply, time = reply_for_object(subscription, sock, select=select)
+        self.assertIsNotNone(reply)
+        sock.close()
+
+    def test_kills_successor_that_doesnt_terminate(self):
+        processes = []
+        Popen = subprocess.Popen
+        def recording_popen(*args, **kwargs):
+            processes.append(Popen(*args, **kwargs))
+            return processes[-1]
+
+        subprocess.Popen = recording_popen
+        try:
+            self.assertFalse(restart(self.server, argv=[sys.executable, '-c', _STUCK_SUCCESSOR],
+                                     ready_timeout_secs=0.5, terminate_timeout_secs=0.5))
+        finally:
+            subprocess.Popen = Popen
+        # Reaped, not left a zombie.
+        self.assertEquals(processes[0].returncode, -signal.SIGKILL)
+
+    def test_restores_close_on_exec(self):
+        fd = self.server.socket.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.assertFalse(restart(self.server, argv=[sys.executable, '-c', 'pass'],
+                                 ready_timeout_secs=10.0))
+        self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+
+
 class SubscriptionTestCase(SingleServerTestCase):
     def setUp(self):
         super(SubscriptionTestCase, self).setUp()
@@ -153,6 +850,26 @@ class SubscriptionTestCase(SingleServerTestCase):
                                        self.sock, timeout_secs=0.01, select=select)
         self.assertValidReceiveAllReply(reply)
 
+    @skipIf(msgpack is None, "msgpack isn't available")
+    def test_negotiates_msgpack_metadata(self):
+        obj = BusinessObject({'event': 'routing/subscribe',
+                              'metadata-encoding': ['msgpack', 'json']}, None)
+        obj.serialize(socket=self.sock)
+        reply, time = reply_for_object(obj, self.sock, select=select)
+        self.assertValidReceiveAllReply(reply)
+        self.assertEquals(reply.metadata['metadata-encoding'], 'msgpack')
+
+    def test_refuses_compressed_payloads_unless_negotiated(self):
+        reply, time = reply_for_object(self.make_send_subscription(), self.sock, select=select)
+        self.assertValidReceiveAllReply(reply)
+
+        text = BusinessObject.from_string(u"compressible text " * 200)
+        self.sock.sendall(str(CompressingEncoder().encode(text)))
+        while len(select.select([self.sock], [], [], 5.0)[0]) > 0:
+            if self.sock.recv(65536) == '':
+                return
+        self.fail(u"Server didn't close the connection")
+
 
 class ClientRegistryTestCase(SingleServerTestCase):
     def setUp(self):
@@ -319,6 +1036,53 @@ class RecipientTestCase(SingleServerTestCase, RecipientBaseTestCase):
         return sock, routing_id
 
 
+class CutThroughTestCase(SingleServerTestCase, RecipientBaseTestCase):
+    def setUp(self):
+        global _host, _port
+
+        self.server = self.start_server(_host, _port, spool_threshold=4096,
+                                        cut_through_threshold=65536)
+        self.clients = []
+        for i in xrange(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((_host, _port))
+            subscription = self.make_send_subscription(sock)
+            reply_for_object(subscription, sock, select=select)
+            self.clients.append(sock)
+
+    def tearDown(self):
+        for sock in self.clients:
+            sock.close()
+
+        super(CutThroughTestCase, self).tearDown()
+
+    def assert_forwards_payload(self, size):
+        payload = bytearray(xrange(256)) * (size / 256)
+        obj = BusinessObject({'type': 'application/octet-stream',
+                              'size': len(payload)}, payload)
+        Greenlet.spawn(obj.serialize, socket=self.clients[0])
+
+        reply = read_object_with_timeout(self.clients[1], timeout_secs=5.0, select=select)
+        while reply is not None and reply.event != None:
+            reply = read_object_with_timeout(self.clients[1], timeout_secs=5.0, select=select)
+        self.assertIsNotNone(reply)
+        self.assertEquals(reply.id, obj.id)
+        self.assertEquals(reply.payload, payload)
+        return reply
+
+    def test_forwards_spooled_payload(self):
+        reply = self.assert_forwards_payload(16384)
+        self.assertIn('sha1', reply.metadata)
+
+    def test_forwards_spooled_payload_below_coalesce_size(self):
+        reply = self.assert_forwards_payload(8192)
+        self.assertIn('sha1', reply.metadata)
+
+    def test_forwards_payload_while_receiving(self):
+        reply = self.assert_forwards_payload(4 * 1024 * 1024)
+        self.assertNotIn('sha1', reply.metadata)
+
+
 class RecipientTwoServerTestCase(TwoServerTestCase, RecipientBaseTestCase):
     def setUp(self):
         super(RecipientTwoServerTestCase, self).setUp()
@@ -353,6 +1117,20 @@ class RecipientTwoServerTestCase(TwoServerTestCase, RecipientBaseTestCase):
 
         self.assert_receives_object(to_client, obj.id)
 
+    def test_local_unicast_stays_local(self):
+        client, routing_id = self.clients[0]
+        to_client, to_routing_id = self.clients[1]
+        statistics = [m for m in self.server2.middlewares
+                      if isinstance(m, StatisticsMiddleware)][0]
+        received = statistics.received_objects
+
+        obj = BusinessObject({'to': to_routing_id}, None)
+        obj.serialize(socket=client)
+
+        self.assert_receives_object(to_client, obj.id)
+        sleep(0.1)
+        self.assertEquals(statistics.received_objects, received)
+
     def make_subscribe_client(self, server, no_echo=False):
         host, port = server.address[:2]
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -365,8 +1143,293 @@ class RecipientTwoServerTestCase(TwoServerTestCase, RecipientBaseTestCase):
         return sock, routing_id
 
 
+class LinkedServersTestCase(BaseTestCase, RecipientBaseTestCase):
+    """
+    Servers linked in whatever way a subclass sets up in self.servers, with
+    clients subscribed to them in self.clients.
+    """
+    def tearDown(self):
+        for sock, routing_id in self.clients:
+            sock.close()
+        for server in self.servers:
+            server.stop(timeout=0)
+
+        super(LinkedServersTestCase, self).tearDown()
+
+    def make_subscribe_client(self, server):
+        host, port = server.address[:2]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+
+        subscription = self.make_send_subscription(sock)
+        resp, time = reply_for_object(subscription, sock, select=select)
+        return sock, resp.metadata['routing-id']
+
+    def middleware(self, server, cls):
+        return [m for m in server.middlewares if isinstance(m, cls)][0]
+
+
+class LinkPoolTestCase(LinkedServersTestCase):
+    def setUp(self):
+        super(LinkPoolTestCase, self).setUp()
+        self.server1 = self.start_server(_host, _port)
+        self.server2 = self.start_server(_host, _port2, linked_servers=[(_host, _port)],
+                                         link_connections=3)
+        self.servers = [self.server1, self.server2]
+        sleep(0.2)
+        self.clients = [self.make_subscribe_client(self.server1),
+                        self.make_subscribe_client(self.server2)]
+
+    def test_links_are_pooled(self):
+        routing1 = self.middleware(self.server1, RoutingMiddleware)
+        routing2 = self.middleware(self.server2, RoutingMiddleware)
+        self.assertEquals(len(routing2.links[routing1.routing_id]), 3)
+        self.assertEquals(len(routing1.links[routing2.routing_id]), 3)
+
+    def record_lanes(self, lanes):
+        """
+        Returns a list per lane, filled with the ids of objects sent over it.
+        """
+        ids = []
+        for lane in lanes:
+            ids.append([])
+            def send(message, sender, sent=ids[-1], send=lane.send):
+                if message.event is None:
+                    sent.append(message.id)
+                send(message, sender)
+            lane.send = send
+        return ids
+
+    def test_objects_are_delivered_once_in_order(self):
+        client, routing_id = self.clients[0]
+        to_client, to_routing_id = self.clients[1]
+        routing1 = self.middleware(self.server1, RoutingMiddleware)
+        routing2 = self.middleware(self.server2, RoutingMiddleware)
+        lanes = self.record_lanes(routing1.links[routing2.routing_id])
+
+        sent = []
+        for size in [10, 200 * 1024, 10, 300 * 1024, 10, 100 * 1024]:
+            payload = (bytearray(xrange(256)) * (size / 256 + 1))[:size]
+            obj = BusinessObject({'to': to_routing_id, 'type': 'application/octet-stream',
+                                  'size': size}, payload)
+            obj.serialize(socket=client)
+            sent.append(obj)
+
+        received = []
+        obj = read_object_with_timeout(to_client, timeout_secs=2.0, select=select)
+        while obj is not None:
+            if obj.event is None:
+                received.append(obj)
+            obj = read_object_with_timeout(to_client, timeout_secs=0.5, select=select)
+
+        small = [obj.id for obj in sent if obj.size < routing1.bulk_link_bytes]
+        large = [obj.id for obj in sent if obj.size >= routing1.bulk_link_bytes]
+        self.assertEquals(sorted(obj.id for obj in received), sorted(small + large))
+        self.assertEquals([obj.id for obj in received if obj.size < routing1.bulk_link_bytes],
+                          small)
+        self.assertEquals([obj.id for obj in received if obj.size >= routing1.bulk_link_bytes],
+                          large)
+        payloads = dict((obj.id, obj.payload) for obj in sent)
+        for obj in received:
+            self.assertEquals(obj.payload, payloads[obj.id])
+
+        self.assertEquals(lanes[0], small)
+        self.assertEquals(sorted(sum(lanes[1:], [])), sorted(large))
+
+    def test_server_disconnects_with_last_link(self):
+        routing1 = self.middleware(self.server1, RoutingMiddleware)
+        routing2 = self.middleware(self.server2, RoutingMiddleware)
+        client, routing_id = self.clients[0]
+        self.server2.stop(timeout=0)
+
+        disconnects = 0
+        obj = read_object_with_timeout(client, timeout_secs=0.5, select=select)
+        while obj is not None:
+            if obj.event == 'routing/disconnect' and \
+               obj.metadata['routing-id'] == routing2.routing_id:
+                disconnects += 1
+            obj = read_object_with_timeout(client, timeout_secs=0.2, select=select)
+
+        self.assertEquals(disconnects, 1)
+        self.assertNotIn(routing2.routing_id, routing1.links)
+
+
+
+class CompressedLinkTestCase(LinkedServersTestCase):
+    def setUp(self):
+        super(CompressedLinkTestCase, self).setUp()
+        self.server1 = self.start_server(_host, _port, compression_threshold=1024)
+        self.server2 = self.start_server(_host, _port2, linked_servers=[(_host, _port)],
+                                         compression_threshold=1024)
+        self.servers = [self.server1, self.server2]
+        sleep(0.2)
+        self.clients = [self.make_subscribe_client(self.server1),
+                        self.make_subscribe_client(self.server2)]
+
+    def test_compressed_payloads_cross_links(self):
+        for server in self.servers:
+            for links in self.middleware(server, RoutingMiddleware).links.values():
+                self.assertIsInstance(links[0].encoder, CompressingEncoder)
+
+        for client, to_client in [(self.clients[0], self.clients[1]),
+                                  (self.clients[1], self.clients[0])]:
+            obj = BusinessObject.from_string(u"compressible text " * 200)
+            obj.metadata['to'] = to_client[1]
+            obj.serialize(socket=client[0])
+
+            reply = read_object_with_timeout(to_client[0], timeout_secs=2.0, select=select)
+            while reply is not None and reply.event != None:
+                reply = read_object_with_timeout(to_client[0], timeout_secs=2.0, select=select)
+            self.assertIsNotNone(reply)
+            self.assertEquals(reply.id, obj.id)
+            self.assertEquals(reply.payload, obj.payload)
+
+
+class LearnedRoutingTestCase(LinkedServersTestCase):
+    def setUp(self):
+        super(LearnedRoutingTestCase, self).setUp()
+        self.server1 = self.start_server(_host, _port)
+        self.server2 = self.start_server(_host, _port2, linked_servers=[(_host, _port)])
+        self.server3 = self.start_server(_host, _port3, linked_servers=[(_host, _port)])
+        self.servers = [self.server1, self.server2, self.server3]
+        sleep(0.2)
+        self.clients = [self.make_subscribe_client(server)
+                        for server in [self.server1, self.server2, self.server3]]
+        sleep(0.1)
+
+    def test_learns_routes_from_links(self):
+        routing = self.middleware(self.server1, RoutingMiddleware)
+        routing3 = self.middleware(self.server3, RoutingMiddleware)
+        to_client, to_routing_id = self.clients[2]
+        self.assertEquals(routing.table.next_hop(to_routing_id), routing3.routing_id)
+
+    def test_addressed_object_goes_toward_destination_only(self):
+        client, routing_id = self.clients[0]
+        to_client, to_routing_id = self.clients[2]
+        statistics = self.middleware(self.server2, StatisticsMiddleware)
+        received = statistics.received_objects
+
+        obj = BusinessObject({'to': to_routing_id}, None)
+        obj.serialize(socket=client)
+
+        self.assert_receives_object(to_client, obj.id)
+        self.assertEquals(statistics.received_objects, received)
+
+    def test_unknown_destination_is_flooded(self):
+        client, routing_id = self.clients[0]
+        statistics = self.middleware(self.server2, StatisticsMiddleware)
+        received = statistics.received_objects
+
+        BusinessObject({'to': str(uuid4())}, None).serialize(socket=client)
+        sleep(0.1)
+        self.assertEquals(statistics.received_objects, received + 1)
+
+    def test_forgets_disconnected_clients(self):
+        routing = self.middleware(self.server1, RoutingMiddleware)
+        to_client, to_routing_id = self.clients[2]
+        to_client.close()
+        sleep(0.1)
+        self.assertIsNone(routing.table.next_hop(to_routing_id))
+
+
+class WorkerLinkTestCase(LinkedServersTestCase):
+    def setUp(self):
+        super(WorkerLinkTestCase, self).setUp()
+        # Like workers.run_workers, without forking.
+        self.server1 = self.start_server(_host, _port)
+        self.hub = StreamServer(('127.0.0.1', 0), self.server1.handle_worker_link)
+        self.hub.start()
+        self.server2 = self.start_server(_host, _port2)
+        self.server2.worker_links.add(self.hub.address)
+        self.server2.link_to_servers.put(self.hub.address)
+        self.servers = [self.server1, self.server2]
+        sleep(0.2)
+        self.clients = [self.make_subscribe_client(server) for server in self.servers]
+        sleep(0.1)
+
+    def tearDown(self):
+        self.hub.stop(timeout=0)
+        super(WorkerLinkTestCase, self).tearDown()
+
+    def test_worker_links_arent_counted_as_clients(self):
+        received = self.middleware(self.server1, StatisticsMiddleware).received_objects
+        for sock, routing_id in self.clients:
+            BusinessObject({'type': 'text/plain'}, 'hello').serialize(socket=sock)
+        sleep(0.1)
+        self.assertEquals(self.middleware(self.server1, StatisticsMiddleware).received_objects,
+                          received + 2)
+
+        for server in self.servers:
+            statistics = self.middleware(server, StatisticsMiddleware).statistics(server.snapshot)
+            self.assertEquals(len(server.snapshot), 2)
+            self.assertEquals(statistics['client count'], 1)
+            self.assertEquals(statistics['clients connected total'], 1)
+
+
+class TriangleTestCase(LinkedServersTestCase):
+    def setUp(self):
+        super(TriangleTestCase, self).setUp()
+        self.server1 = self.start_server(_host, _port)
+        self.server2 = self.start_server(_host, _port2, linked_servers=[(_host, _port)])
+        self.server3 = self.start_server(_host, _port3,
+                                         linked_servers=[(_host, _port), (_host, _port2)])
+        self.servers = [self.server1, self.server2, self.server3]
+        sleep(0.2)
+        self.clients = [self.make_subscribe_client(server)
+                        for server in [self.server1, self.server2, self.server3]]
+        sleep(0.1)
+
+    def test_objects_are_delivered_once(self):
+        client, routing_id = self.clients[1]
+        to_client, to_routing_id = self.clients[2]
+
+        obj = BusinessObject({'type': 'text/plain'}, 'hello')
+        obj.serialize(socket=client)
+
+        received = 0
+        reply = read_object_with_timeout(to_client, timeout_secs=0.5, select=select)
+        while reply is not None:
+            if reply.id == obj.id:
+                received += 1
+            reply = read_object_with_timeout(to_client, timeout_secs=0.3, select=select)
+
+        self.assertEquals(received, 1)
+        self.assertGreater(self.server3.duplicates_dropped, 0)
+
+    def test_addressed_object_survives_disagreeing_routes(self):
+        client, routing_id = self.clients[0]
+        to_client, to_routing_id = self.clients[2]
+        routing1 = self.middleware(self.server1, RoutingMiddleware)
+        routing2 = self.middleware(self.server2, RoutingMiddleware)
+        routing3 = self.middleware(self.server3, RoutingMiddleware)
+
+        # Both learn the forwarded copy first, so each takes the other as
+        # the way to to_client.
+        routing1.table.next_hops.clear()
+        routing2.table.next_hops.clear()
+        routing1.table.learn(BusinessObject({'route': [to_routing_id, routing3.routing_id,
+                                                       routing2.routing_id]}, None),
+                             routing2.routing_id)
+        routing2.table.learn(BusinessObject({'route': [to_routing_id, routing3.routing_id,
+                                                       routing1.routing_id]}, None),
+                             routing1.routing_id)
+        self.assertEquals(routing1.table.next_hop(to_routing_id), routing2.routing_id)
+        self.assertEquals(routing2.table.next_hop(to_routing_id), routing1.routing_id)
+
+        obj = BusinessObject({'to': to_routing_id}, None)
+        obj.serialize(socket=client)
+
+        received = 0
+        reply = read_object_with_timeout(to_client, timeout_secs=0.5, select=select)
+        while reply is not None:
+            if reply.id == obj.id:
+                received += 1
+            reply = read_object_with_timeout(to_client, timeout_secs=0.3, select=select)
+        self.assertEquals(received, 1)
+
+
 def main():
-    global _host, _port, _port2
+    global _host, _port, _port2, _port3
     parser = OptionParser()
     parser.add_option("-d", "--debug", action="store_true", dest="debug", default=False,
                       help="logging level DEBUG")
@@ -374,6 +1437,7 @@ def main():
     parser.add_option("--host", dest="host", default="localhost")
     parser.add_option("--port", dest="port", default=17890, type="int")
     parser.add_option("--port2", dest="port2", default=17891, type="int")
+    parser.add_option("--port3", dest="port3", default=17892, type="int")
 
     opts, args = parser.parse_args()
 
@@ -384,6 +1448,7 @@ def main():
     _host = opts.host
     _port = opts.port
     _port2 = opts.port2
+    _port3 = opts.port3
 
     unittest_main()
 
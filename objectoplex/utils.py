@@ -2,12 +2,15 @@
 from __future__ import print_function
 
 import select
-import json
+import socket
 
 from sys import stdout
 from datetime import datetime, timedelta
 
-from system import BusinessObject
+import jsoncodec
+
+from system import BusinessObject, InvalidObject
+from protocol import reader_for
 
 
 non_readable_keys = frozenset(['route', 'id', 'in-reply-to', 'avoid', 'size',
@@ -18,6 +21,18 @@ system_parsed_keys = frozenset(['type', 'event'])
 def _total_seconds(delta):
     return (delta.microseconds + (delta.seconds + delta.days * 24 * 3600) * 1e6) / 1e6
 
+def wait_readable(sock, timeout_secs=1.0, select=select):
+    """
+    Returns True if an object can be read from the socket without blocking
+    for the first bytes, i.e. the socket's reader has buffered data or the
+    socket itself is readable within timeout_secs.
+    """
+    if reader_for(sock).pending():
+        return True
+
+    rlist, wlist, xlist = select.select([sock], [], [], timeout_secs)
+    return len(rlist) > 0
+
 def reply_for_object(obj, sock, timeout_secs=1.0, select=select):
     """
     Waits for a reply to a sent object (connected by in-reply-to field).
@@ -29,16 +44,17 @@ def reply_for_object(obj, sock, timeout_secs=1.0, select=select):
     """
     started = datetime.now()
     delta = timedelta(seconds=timeout_secs)
+    reader = reader_for(sock)
     while True:
-        rlist, wlist, xlist = select.select([sock], [], [], 0.0001)
+        readable = wait_readable(sock, 0.0001, select=select)
 
         if datetime.now() > started + delta:
             return None, timeout_secs
 
-        if len(rlist) == 0:
+        if not readable:
             continue
 
-        reply = BusinessObject.read_from_socket(sock)
+        reply = BusinessObject.read_from_socket(reader)
 
         if reply is None:
             raise InvalidObject
@@ -50,9 +66,7 @@ def reply_for_object(obj, sock, timeout_secs=1.0, select=select):
                 return reply, _total_seconds(took)
 
 def read_object_with_timeout(sock, timeout_secs=1.0, select=select):
-    rlist, wlist, xlist = select.select([sock], [], [], timeout_secs)
-
-    if len(rlist) > 0:
+    if wait_readable(sock, timeout_secs, select=select):
         return BusinessObject.read_from_socket(sock)
 
 def registration_object(client_name, user_name):
@@ -65,12 +79,34 @@ def registration_object(client_name, user_name):
         }
     return BusinessObject(metadata, None)
 
-def subscription_object(subscriptions=[], echo=False):
+def connect(host='localhost', port=7890, path=None, socket=socket):
+    """
+    Returns a socket connected to the server, at the Unix domain socket path
+    if given and at host:port otherwise.
+
+    socket-module is parameterizable like select in reply_for_object.
+    """
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+    return sock
+
+def subscription_object(subscriptions=[], echo=False, metadata_encoding=None,
+                        payload_compression=None, backpressure=None):
     metadata = {
         'event': 'routing/subscribe',
         'subscriptions': subscriptions,
         'echo': echo
     }
+    if metadata_encoding is not None:
+        metadata['metadata-encoding'] = metadata_encoding
+    if payload_compression is not None:
+        metadata['payload-compression'] = payload_compression
+    if backpressure is not None:
+        metadata['backpressure'] = backpressure
     return BusinessObject(metadata, None)
 
 def format_readably(obj, file=None, no_payload=False, include=set(), exclude=set()):
@@ -104,19 +140,18 @@ def format_readably(obj, file=None, no_payload=False, include=set(), exclude=set
 
     for key in sorted(list(print_keys)):
         snippet = u"{0}={1}".format(key,
-                                    json.dumps(obj.metadata[key], ensure_ascii=False))
+                                    jsoncodec.dumps(obj.metadata[key]))
         snippets.append(snippet)
 
     if obj.content_type is not None:
         snippets.insert(0, u"{0}={1}".format('type',
-                                             json.dumps(unicode(obj.content_type),
-                                                        ensure_ascii=False)))
+                                             jsoncodec.dumps(unicode(obj.content_type))))
     if obj.event is not None:
         snippets.insert(0, u"{0}={1}".format('event',
-                                             json.dumps(obj.event, ensure_ascii=False)))
+                                             jsoncodec.dumps(obj.event)))
 
     if len(hidden_keys) > 0:
-        snippets.append(u"_hidden={0}".format(json.dumps(sorted(list(hidden_keys)), ensure_ascii=False)))
+        snippets.append(u"_hidden={0}".format(jsoncodec.dumps(sorted(list(hidden_keys)))))
 
     if file is not None:
         if text is not None:
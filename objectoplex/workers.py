@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Running ObjectoPlex in several worker processes that accept connections on
+the same port (SO_REUSEPORT).
+
+The workers are ordinary linked servers: worker 0 additionally listens on a
+local hub socket and every other worker links to it, so objects (and
+routing state) flow between workers through the usual server links and the
+middleware API stays the same.  The workers form a star, so nothing is
+delivered twice.  Links to other servers are made by worker 0 only.
+
+Worker 0 is a bottleneck: every other worker subscribes to everything over
+its hub link, so worker 0 decodes and relays all objects sent by the
+clients of every worker, whether or not any client elsewhere subscribes to
+them.  Adding workers thus scales accepting and serving clients, but not
+throughput of the objects they all see.  Hub links aren't counted as
+clients in the statistics.
+
+Statistics of the workers are published to a shared memory map so that a
+server/statistics reply can cover all of them.
+"""
+import errno
+import logging
+import mmap
+import os
+import signal
+import socket
+import struct
+
+import gevent
+
+from gevent.server import StreamServer
+
+import jsoncodec
+
+from system import IdGenerator, set_id_generator
+
+logger = logging.getLogger('workers')
+
+_SLOT_BYTES = 65536
+_SLOT_LENGTH = struct.Struct('>I')
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15) # 15 on Linux
+
+
+def reuseport_listener(address, backlog=256):
+    """
+    Returns a listening socket bound to address that other processes can
+    bind to as well, the kernel distributing connections among them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+class SharedStatistics(object):
+    """
+    A slot of shared memory per worker, holding the latest statistics of
+    the worker as JSON.  Must be created before the workers are forked.
+    """
+    def __init__(self, workers, slot_bytes=_SLOT_BYTES):
+        self.workers = workers
+        self.slot_bytes = slot_bytes
+        self.map = mmap.mmap(-1, workers * slot_bytes)
+
+    def publish(self, worker, statistics):
+        data = jsoncodec.dumpb(statistics)
+        if len(data) + _SLOT_LENGTH.size > self.slot_bytes:
+            logger.warning(u"Statistics of worker {0} don't fit in {1} bytes".format(
+                worker, self.slot_bytes))
+            return
+
+        start = worker * self.slot_bytes
+        # The length is written last; a reader never sees a partial write
+        # as the previous length is zeroed first.
+        self.map[start:start + _SLOT_LENGTH.size] = _SLOT_LENGTH.pack(0)
+        self.map[start + _SLOT_LENGTH.size:start + _SLOT_LENGTH.size + len(data)] = data
+        self.map[start:start + _SLOT_LENGTH.size] = _SLOT_LENGTH.pack(len(data))
+
+    def collect(self, exclude=None):
+        """
+        Returns the published statistics of all workers but exclude.
+        """
+        ret = []
+        for worker in xrange(self.workers):
+            if worker == exclude:
+                continue
+
+            start = worker * self.slot_bytes
+            length = _SLOT_LENGTH.unpack(self.map[start:start + _SLOT_LENGTH.size])[0]
+            if length == 0:
+                continue
+            data = self.map[start + _SLOT_LENGTH.size:start + _SLOT_LENGTH.size + length]
+            try:
+                ret.append(jsoncodec.loads(data))
+            except ValueError, ve:
+                pass
+        return ret
+
+def merge_statistics(statistics, averaged=()):
+    """
+    Sums the numbers (and, recursively, dicts of numbers) of a list of
+    statistics dicts; keys in averaged are averaged instead.
+    """
+    ret = {}
+    for stats in statistics:
+        for key, value in stats.iteritems():
+            if isinstance(value, dict):
+                ret[key] = merge_statistics([ret.get(key, {}), value])
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                ret[key] = ret.get(key, 0) + value
+            else:
+                ret.setdefault(key, value)
+
+    for key in averaged:
+        if key in ret and len(statistics) > 0:
+            ret[key] = float(ret[key]) / len(statistics)
+    return ret
+
+
+def run_workers(count, address, linked_servers, make_server):
+    """
+    Forks count workers serving address.  make_server is called in each
+    worker with the listening socket, the servers to link to and the worker
+    index and returns a (not yet started) ObjectoPlex.  Waits for the
+    workers to exit; SIGTERM and SIGINT are passed on to them.
+    """
+    hub = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    hub.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    hub.bind(('127.0.0.1', 0))
+    hub.listen(64)
+    hub.setblocking(0)
+    hub_address = hub.getsockname()
+
+    pids = []
+    for index in xrange(count):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(index, address, hub, hub_address, linked_servers, make_server)
+            os._exit(0)
+        pids.append(pid)
+    hub.close()
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid in pids:
+            pids.remove(pid)
+            logger.info(u"Worker {0} exited with status {1}".format(pid, status))
+
+def _run_worker(index, address, hub, hub_address, linked_servers, make_server):
+    gevent.reinit()
+    # The id generator was inherited from the parent; ids must not collide.
+    set_id_generator(IdGenerator())
+
+    if index == 0:
+        links = linked_servers
+    else:
+        hub.close()
+        links = [hub_address]
+
+    server = make_server(reuseport_listener(address), links, index)
+    if index == 0:
+        hub_server = StreamServer(hub, server.handle_worker_link)
+        hub_server.start()
+    else:
+        server.worker_links.add(hub_address)
+
+    logger.info(u"Worker {0} (pid {1}) serving at {2}:{3}".format(index, os.getpid(), *address))
+    gevent.signal(signal.SIGTERM, server.stop)
+    gevent.signal(signal.SIGINT, server.stop)
+    server.serve_forever()